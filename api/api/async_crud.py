@@ -0,0 +1,53 @@
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas
+from .auth import get_password_hash_async, user_cache
+
+# Async counterparts of the user operations in crud.py, for routes served on the event loop
+
+async def get_user(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.User).where(models.User.id == user_id))
+    return result.scalar_one_or_none()
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalar_one_or_none()
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(models.User).offset(skip).limit(limit))
+    return result.scalars().all()
+
+async def count_admin_users(db: AsyncSession):
+    result = await db.execute(select(func.count(models.User.id)).where(models.User.is_admin == True))
+    return result.scalar()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    hashed_password = await get_password_hash_async(user.password)
+    db_user = models.User(username=user.username, password_hash=hashed_password, is_admin=user.is_admin)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+async def update_user(db: AsyncSession, user_id: int, user: schemas.UserUpdate):
+    db_user = await get_user(db, user_id)
+    if db_user:
+        update_data = user.dict(exclude_unset=True)
+        if "password" in update_data:
+            update_data["password_hash"] = await get_password_hash_async(update_data.pop("password"))
+        for key, value in update_data.items():
+            setattr(db_user, key, value)
+        await db.commit()
+        await db.refresh(db_user)
+        # Role or name changes must apply to tokens already in circulation
+        user_cache.invalidate_user(user_id)
+    return db_user
+
+async def delete_user(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id)
+    if db_user:
+        await db.delete(db_user)
+        await db.commit()
+        user_cache.invalidate_user(user_id)
+        return True
+    return False
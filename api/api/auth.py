@@ -1,14 +1,18 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from . import schemas, models
-from .database import get_db
+from . import coordination, metrics, schemas, models
+from .database import get_async_db
 
 load_dotenv()
 
@@ -18,16 +22,159 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # Token expires after 1 hour
 
 # Set up password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+_pwd_context = None
+
+# bcrypt is CPU-bound and slow by design; it runs on a small dedicated pool, never on the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Login attempts allowed per window before further attempts are rejected unhashed
+LOGIN_THROTTLE_WINDOW = float(os.getenv("LOGIN_THROTTLE_WINDOW", "60"))  # seconds
+LOGIN_MAX_ATTEMPTS_PER_USER = int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_USER", "10"))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_IP", "30"))
 
 # OAuth2 scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Verified tokens are remembered for a short while to skip the JWT decode and user query
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # seconds
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+
+class UserCache:
+    """
+    TTL + LRU cache mapping a verified token to its claims and a user snapshot.
+    With a `generation`, invalidations are shared across worker processes:
+    each process drops its entries once it sees the generation change.
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL, maxsize=USER_CACHE_SIZE, generation=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = generation
+        self._seen_generation = generation.current() if generation else 0
+
+    def _sync_generation(self):
+        if self._generation is None:
+            return
+        current = self._generation.current()
+        if current != self._seen_generation:
+            self._entries.clear()
+            self._seen_generation = current
+
+    def get(self, token):
+        with self._lock:
+            self._sync_generation()
+            entry = self._entries.get(token)
+            if entry is not None:
+                expires_at, claims, user = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    metrics.user_cache_lookups.inc(result="hit")
+                    return claims, user
+                del self._entries[token]
+            self.misses += 1
+            metrics.user_cache_lookups.inc(result="miss")
+            return None
+
+    def put(self, token, claims, user):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        # Never outlive the token itself
+        expires_at = min(time.time() + self.ttl, claims.get("exp", float("inf")))
+        with self._lock:
+            self._entries[token] = (expires_at, claims, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        # Every process, this one included, drops all its entries when it sees
+        # the new generation; only this process could tell which were affected
+        if self._generation is not None:
+            self._generation.bump()
+        with self._lock:
+            for token in [token for token, (_, _, user) in self._entries.items() if user.id == user_id]:
+                del self._entries[token]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+user_cache = UserCache(generation=coordination.Generation("users"))
+
+def get_pwd_context():
+    # passlib and bcrypt are loaded on the first hash or verify, not at startup
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+    return _pwd_context
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
+
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, get_password_hash, password)
+
+LOGIN_THROTTLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS login_attempts (key TEXT NOT NULL, attempted_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_login_attempts_key ON login_attempts (key, attempted_at);
+CREATE INDEX IF NOT EXISTS ix_login_attempts_attempted_at ON login_attempts (attempted_at);
+"""
+
+class LoginThrottle:
+    """
+    Sliding-window limit on login attempts, keyed by username and by client IP.
+    Attempts are recorded in coordination.SharedState, so the limits hold across
+    every API worker rather than multiplying with their number.
+    """
+
+    def __init__(self, window=LOGIN_THROTTLE_WINDOW, max_per_user=LOGIN_MAX_ATTEMPTS_PER_USER, max_per_ip=LOGIN_MAX_ATTEMPTS_PER_IP):
+        self.window = window
+        self.limits = {"user": max_per_user, "ip": max_per_ip}
+        self.rejected = 0
+        self._state = coordination.SharedState(LOGIN_THROTTLE_SCHEMA)
+
+    def check(self, username, ip):
+        """Record an attempt and return 0, or the seconds to wait if it is over the limit."""
+        now = time.time()
+        keys = [("user", f"user:{username}"), ("ip", f"ip:{ip}")]
+        with self._state.transaction() as db:
+            # Expired attempts go on every check, so a spray of usernames can't grow the table
+            db.execute("DELETE FROM login_attempts WHERE attempted_at <= ?", (now - self.window,))
+            retry_after = 0
+            for kind, key in keys:
+                count, oldest = db.execute("SELECT COUNT(*), MIN(attempted_at) FROM login_attempts WHERE key = ?", (key,)).fetchone()
+                if count >= self.limits[kind]:
+                    retry_after = max(retry_after, oldest + self.window - now)
+            if retry_after:
+                self.rejected += 1
+                return retry_after
+            db.executemany("INSERT INTO login_attempts (key, attempted_at) VALUES (?, ?)", [(key, now) for _, key in keys])
+        return 0
+
+    def reset_user(self, username):
+        with self._state.transaction() as db:
+            db.execute("DELETE FROM login_attempts WHERE key = ?", (f"user:{username}",))
+
+login_throttle = LoginThrottle()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -36,15 +183,23 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_verified_token(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """Return the (claims, user snapshot) for a bearer token, from the cache when possible."""
+    cached = user_cache.get(token)
+    if cached:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # Loaded on first use; cached tokens never get here
+    from jose import JWTError, jwt
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -54,10 +209,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
     # Direct query to avoid circular dependency
-    user = db.query(models.User).filter(models.User.username == token_data.username).first()
+    result = await db.execute(select(models.User).where(models.User.username == token_data.username))
+    user = result.scalar_one_or_none()
     if user is None:
         raise credentials_exception
-    return user
+
+    snapshot = schemas.User.model_validate(user)
+    user_cache.put(token, payload, snapshot)
+    return payload, snapshot
+
+async def get_current_user(verified = Depends(get_verified_token)):
+    return verified[1]
 
 async def get_current_active_user(current_user = Depends(get_current_user)):
     return current_user
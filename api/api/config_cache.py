@@ -0,0 +1,54 @@
+import threading
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from . import coordination, metrics, models
+from .database import SessionLocal
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    version: int
+    email_address: Optional[str]
+    email_password: Optional[str]
+    # (channel_name, webhook_url) for active webhooks only
+    active_webhooks: Tuple[Tuple[str, str], ...]
+    # Discord mentions for every active role, ready to drop into a message
+    role_mentions: str
+
+# Shared by all worker processes, so a write in one invalidates the snapshot in every other
+_generation = coordination.Generation("config")
+_snapshot = None
+_lock = threading.Lock()
+
+def invalidate():
+    """Mark the snapshot stale; called by every write to credentials, webhooks or roles."""
+    _generation.bump()
+
+def _build(db, version):
+    credentials = db.query(models.EmailCredentials).first()
+    webhooks = db.query(models.Webhook.channel_name, models.Webhook.webhook_url).filter(models.Webhook.is_active == True).all()
+    roles = db.query(models.DiscordRole.role_id).filter(models.DiscordRole.is_active == True).all()
+    return ConfigSnapshot(
+        version=version,
+        email_address=credentials.email_address if credentials else None,
+        email_password=credentials.email_password if credentials else None,
+        active_webhooks=tuple((webhook.channel_name, webhook.webhook_url) for webhook in webhooks),
+        role_mentions=" ".join(f"<@&{role.role_id}>" for role in roles),
+    )
+
+def get_snapshot():
+    """Return the current snapshot, loading it from the database only after a write."""
+    global _snapshot
+    version = _generation.current()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        metrics.config_cache_lookups.inc(result="hit")
+        return snapshot
+    metrics.config_cache_lookups.inc(result="miss")
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            db = SessionLocal()
+            try:
+                _snapshot = _build(db, version)
+            finally:
+                db.close()
+        return _snapshot
@@ -0,0 +1,174 @@
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from .database import CONFIG_DIR
+
+# Lock and generation files shared by every API worker process
+LOCK_DIR = os.path.join(CONFIG_DIR, "locks")
+os.makedirs(LOCK_DIR, exist_ok=True)
+
+# Identifies this process as the owner of the delivery jobs it claims
+PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+def _lock_path(name):
+    return os.path.join(LOCK_DIR, f"{name}.lock")
+
+@contextmanager
+def file_lock(name):
+    """Hold an exclusive lock across processes, waiting for it if another process has it."""
+    with open(_lock_path(name), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class LeaderLock:
+    """
+    Non-blocking lock that elects one process to run a singleton task. The
+    lock is released by the kernel when its holder exits, so another process
+    takes over the next time it calls acquire().
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._file = None
+
+    def acquire(self):
+        if self._file is not None:
+            return True
+        lock_file = open(_lock_path(self.name), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+_process_lock = LeaderLock(f"process-{PROCESS_ID}")
+
+def register_process():
+    # Held for the life of the process, so others can tell whether it is still running
+    _process_lock.acquire()
+
+def is_registered():
+    return _process_lock.held
+
+def unregister_process():
+    _process_lock.release()
+    try:
+        os.remove(_lock_path(_process_lock.name))
+    except FileNotFoundError:
+        pass
+
+def is_process_alive(process_id):
+    path = _lock_path(f"process-{process_id}")
+    if not os.path.exists(path):
+        return False
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    # Nobody holds it: the process exited without cleaning up
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return False
+
+def write_state(name, value):
+    """Publish a small JSON value to every worker; the file is replaced atomically."""
+    path = os.path.join(LOCK_DIR, f"{name}.json")
+    temporary = f"{path}.{PROCESS_ID}"
+    with open(temporary, "w") as state_file:
+        json.dump(value, state_file, default=str)
+    os.replace(temporary, path)
+
+def read_state(name):
+    try:
+        with open(os.path.join(LOCK_DIR, f"{name}.json")) as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+class Generation:
+    """
+    A counter shared across processes through a small file holding its value.
+    Writers bump it; readers compare it with the value their cached data was
+    built from. The value is stored in the file rather than in its mtime,
+    which coarse-resolution filesystems (FAT, some network mounts) would
+    round, losing bumps made within one tick.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(LOCK_DIR, f"{name}.generation")
+
+    def current(self):
+        try:
+            with open(self.path) as generation_file:
+                return int(generation_file.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self):
+        with file_lock("generation"):
+            value = self.current() + 1
+            # Replaced atomically, so readers never see a partly written value
+            temporary = f"{self.path}.{PROCESS_ID}"
+            with open(temporary, "w") as generation_file:
+                generation_file.write(str(value))
+            os.replace(temporary, self.path)
+        return value
+
+class SharedState:
+    """
+    Small, fast-changing state every worker must agree on (throttle windows,
+    rate-limit buckets), kept in a SQLite file next to the lock files. It is
+    separate from the app database so these writes never wait on it, and each
+    user creates its own tables with `schema`. Times stored in it must come
+    from time.time(): monotonic clocks aren't comparable between processes.
+    """
+
+    path = os.path.join(LOCK_DIR, "shared-state.db")
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few writes in a power cut only forgets some rate limits
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.executescript(self.schema)
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction; other processes wait for it rather than interleave."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
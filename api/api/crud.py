@@ -1,9 +1,29 @@
+import html
+import re
+from sqlalchemy import DateTime, bindparam, func, insert, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from datetime import datetime
-from . import models, schemas
-from .auth import get_password_hash, verify_password
+from . import models, schemas, config_cache
+from .auth import get_password_hash, user_cache, verify_password
 from typing import Optional
 
+SQLITE_MAX_PARAMS = 30000
+
+# Due-job lookups go through the partial (due_at, priority) index over queued
+# jobs. The planner would otherwise pick the plain status index and sort every
+# pending scheduled job; the literal status is what lets the partial index apply
+DUE_JOB_QUERY = text("""
+    SELECT * FROM delivery_jobs INDEXED BY ix_delivery_jobs_due_at_priority
+    WHERE status = 'queued' AND due_at <= :now
+    ORDER BY priority, due_at, id
+    LIMIT 1
+""").bindparams(bindparam("now", type_=DateTime))
+NEXT_DUE_AT_QUERY = text("""
+    SELECT MIN(due_at) AS due_at FROM delivery_jobs INDEXED BY ix_delivery_jobs_due_at_priority
+    WHERE status = 'queued'
+""").columns(due_at=DateTime)
+
 # User CRUD operations
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
@@ -32,6 +52,8 @@ def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
             setattr(db_user, key, value)
         db.commit()
         db.refresh(db_user)
+        # Role or name changes must apply to tokens already in circulation
+        user_cache.invalidate_user(user_id)
     return db_user
 
 def delete_user(db: Session, user_id: int):
@@ -39,6 +61,7 @@ def delete_user(db: Session, user_id: int):
     if db_user:
         db.delete(db_user)
         db.commit()
+        user_cache.invalidate_user(user_id)
         return True
     return False
 
@@ -61,6 +84,14 @@ def create_webhook(db: Session, webhook: schemas.WebhookCreate):
     db.add(db_webhook)
     db.commit()
     db.refresh(db_webhook)
+    config_cache.invalidate()
+    return db_webhook
+
+def update_webhook(db: Session, db_webhook: models.Webhook, webhook: schemas.WebhookUpdate):
+    db_webhook.is_active = webhook.is_active
+    db.commit()
+    db.refresh(db_webhook)
+    config_cache.invalidate()
     return db_webhook
 
 def delete_webhook_by_channel_name(db: Session, channel_name: str):
@@ -68,6 +99,7 @@ def delete_webhook_by_channel_name(db: Session, channel_name: str):
     if db_webhook:
         db.delete(db_webhook)
         db.commit()
+        config_cache.invalidate()
         return True
     return False
 
@@ -84,6 +116,40 @@ def create_tautulli_credentials(db: Session, credentials: schemas.TautulliCreden
 def get_emails(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Email).offset(skip).limit(limit).all()
 
+def count_emails(db: Session):
+    return db.query(func.count(models.Email.id)).scalar()
+
+def iter_recipient_chunks(db: Session, chunk_size: int = 500):
+    # Same walk as iter_email_chunks, also loading the names used by templates
+    last_email = None
+    while True:
+        query = db.query(models.Email.email, models.Email.username, models.Email.friendly_name).order_by(models.Email.email)
+        if last_email is not None:
+            query = query.filter(models.Email.email > last_email)
+        chunk = query.limit(chunk_size).all()
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_email = chunk[-1].email
+
+def iter_email_chunks(db: Session, chunk_size: int = 500):
+    # Keyset pagination over the unique emails.email index: each page is a
+    # bounded range scan and only the address column is loaded
+    last_email = None
+    while True:
+        query = db.query(models.Email.email).order_by(models.Email.email)
+        if last_email is not None:
+            query = query.filter(models.Email.email > last_email)
+        chunk = [row.email for row in query.limit(chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_email = chunk[-1]
+
 def create_email(db: Session, email: schemas.EmailCreate):
     db_email = models.Email(email=email.email)
     db.add(db_email)
@@ -100,12 +166,52 @@ def delete_email(db: Session, email: str):
         return True
     return False
 
+def sync_emails(db: Session, emails, profiles: Optional[dict] = None):
+    """
+    Add every address in `emails` that isn't excluded and remove those that
+    are, diffing against the current tables in memory and applying the
+    result in a single transaction. `profiles` maps an address to its
+    (username, friendly_name), kept up to date on the stored rows.
+    Returns (added, removed).
+    """
+    profiles = profiles or {}
+    incoming = set(emails)
+    existing = {row.email: (row.username, row.friendly_name) for row in db.query(models.Email.email, models.Email.username, models.Email.friendly_name)}
+    excluded = {row.email for row in get_exclusion_emails(db)}
+
+    to_insert = sorted(incoming - excluded - existing.keys())
+    to_delete = sorted(incoming & excluded & existing.keys())
+    to_update = sorted(email for email in (incoming - excluded) & existing.keys() if email in profiles and profiles[email] != existing[email])
+
+    if to_insert:
+        statement = sqlite_insert(models.Email).on_conflict_do_nothing(index_elements=["email"])
+        db.execute(statement, [{"email": email, **_profile_fields(profiles.get(email))} for email in to_insert])
+    if to_update:
+        table = models.Email.__table__
+        statement = table.update().where(table.c.email == bindparam("match_email")).values(
+            username=bindparam("username"), friendly_name=bindparam("friendly_name")
+        )
+        db.execute(statement, [{"match_email": email, **_profile_fields(profiles[email])} for email in to_update])
+    # Chunked to stay under SQLite's bound-parameter limit
+    for start in range(0, len(to_delete), SQLITE_MAX_PARAMS):
+        chunk = to_delete[start:start + SQLITE_MAX_PARAMS]
+        db.query(models.Email).filter(models.Email.email.in_(chunk)).delete(synchronize_session=False)
+    db.commit()
+    return len(to_insert), len(to_delete)
+
+def _profile_fields(profile):
+    username, friendly_name = profile or (None, None)
+    return {"username": username, "friendly_name": friendly_name}
+
 def get_email_by_address(db: Session, email: str):
     return db.query(models.Email).filter(models.Email.email == email).first()
 
 def get_exclusion_list(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.ExclusionList).offset(skip).limit(limit).all()
 
+def get_exclusion_emails(db: Session):
+    return db.query(models.ExclusionList.email).all()
+
 def get_exclusion_by_email(db: Session, email: str):
     return db.query(models.ExclusionList).filter(models.ExclusionList.email == email).first()
 
@@ -132,6 +238,15 @@ def create_email_credentials(db: Session, credentials: schemas.EmailCredentialsC
     db.add(db_credentials)
     db.commit()
     db.refresh(db_credentials)
+    config_cache.invalidate()
+    return db_credentials
+
+def update_email_credentials(db: Session, db_credentials: models.EmailCredentials, credentials: schemas.EmailCredentialsCreate):
+    db_credentials.email_address = credentials.email_address
+    db_credentials.email_password = credentials.email_password
+    db.commit()
+    db.refresh(db_credentials)
+    config_cache.invalidate()
     return db_credentials
 
 def delete_email_credentials(db: Session):
@@ -139,6 +254,7 @@ def delete_email_credentials(db: Session):
     if db_credentials:
         db.delete(db_credentials)
         db.commit()
+        config_cache.invalidate()
         return True
     return False
 
@@ -147,6 +263,7 @@ def create_discord_role(db: Session, discord_role: schemas.DiscordRoleCreate):
     db.add(db_discord_role)
     db.commit()
     db.refresh(db_discord_role)
+    config_cache.invalidate()
     return db_discord_role
 
 def get_discord_roles(db: Session, skip: int = 0, limit: int = 100):
@@ -165,6 +282,7 @@ def update_discord_role(db: Session, role: schemas.DiscordRoleUpdate):
         db_role.is_active = role.is_active
     db.commit()
     db.refresh(db_role)
+    config_cache.invalidate()
     return db_role
 
 def delete_discord_role(db: Session, role_id: str):
@@ -172,6 +290,7 @@ def delete_discord_role(db: Session, role_id: str):
     if db_discord_role:
         db.delete(db_discord_role)
         db.commit()
+        config_cache.invalidate()
         return True
     return False
 
@@ -183,7 +302,83 @@ def create_sent_message(db: Session, sent_message: schemas.SentMessageCreate):
     return db_sent_message
 
 def get_sent_messages(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.SentMessage).offset(skip).limit(limit).all()
+    return db.query(models.SentMessage).order_by(models.SentMessage.timestamp, models.SentMessage.id).offset(skip).limit(limit).all()
+
+def get_sent_message(db: Session, message_id: int):
+    return db.query(models.SentMessage).filter(models.SentMessage.id == message_id).first()
+
+def get_sent_message_page(db: Session, limit: int = 50, before: Optional[tuple] = None, preview_length: int = 200):
+    """
+    Newest-first page of message summaries. `before` is the (timestamp, id)
+    of the last row of the previous page; seeking past it on the composite
+    index costs the same no matter how deep the page is.
+    """
+    query = db.query(
+        models.SentMessage.id,
+        models.SentMessage.subject,
+        models.SentMessage.services,
+        models.SentMessage.timestamp,
+        # One extra character tells us whether the preview was cut short
+        func.substr(models.SentMessage.body, 1, preview_length + 1).label("body_preview"),
+    ).order_by(models.SentMessage.timestamp.desc(), models.SentMessage.id.desc())
+    if before is not None:
+        query = query.filter(tuple_(models.SentMessage.timestamp, models.SentMessage.id) < tuple_(*before))
+
+    items = []
+    for row in query.limit(limit):
+        body_preview = row.body_preview or ""
+        items.append({
+            "id": row.id,
+            "subject": row.subject,
+            "services": row.services,
+            "timestamp": row.timestamp,
+            "body_preview": body_preview[:preview_length],
+            "body_truncated": len(body_preview) > preview_length,
+        })
+    return items
+
+def build_match_query(search: str):
+    # Quote every term so user input can't form FTS5 syntax; the last term matches as a prefix
+    terms = re.findall(r"\w+", search)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+# FTS5 wraps matches in these control characters; the text is HTML-escaped before they become <mark>
+_MATCH_START, _MATCH_END = "\x02", "\x03"
+
+def _mark_matches(value):
+    if value is None:
+        return None
+    return html.escape(value).replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>")
+
+def search_sent_messages(db: Session, search: str, limit: int = 20, offset: int = 0):
+    match_query = build_match_query(search)
+    if match_query is None:
+        return []
+    # bm25 weights: a hit in the subject counts ten times a hit in the body
+    rows = db.execute(text("""
+        SELECT m.id, m.subject, m.services, m.timestamp,
+               highlight(sent_messages_fts, 0, :match_start, :match_end) AS subject_highlight,
+               snippet(sent_messages_fts, 1, :match_start, :match_end, '…', 32) AS body_snippet,
+               bm25(sent_messages_fts, 10.0, 1.0) AS rank
+        FROM sent_messages_fts
+        JOIN sent_messages m ON m.id = sent_messages_fts.rowid
+        WHERE sent_messages_fts MATCH :match_query
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    """).columns(timestamp=DateTime), {
+        "match_query": match_query, "match_start": _MATCH_START, "match_end": _MATCH_END, "limit": limit, "offset": offset,
+    })
+    items = []
+    for row in rows:
+        item = dict(row._mapping)
+        item["subject_highlight"] = _mark_matches(item["subject_highlight"])
+        item["body_snippet"] = _mark_matches(item["body_snippet"])
+        items.append(item)
+    return items
 
 def delete_all_sent_messages(db: Session):
     db.query(models.SentMessage).delete()
@@ -199,6 +394,17 @@ def create_message_template(db: Session, template: schemas.MessageTemplateCreate
     db.refresh(db_template)
     return db_template
 
+def get_message_template(db: Session, template_id: int):
+    return db.query(models.MessageTemplate).filter(models.MessageTemplate.id == template_id).first()
+
+def update_message_template(db: Session, db_template: models.MessageTemplate, template: schemas.MessageTemplateCreate):
+    for key, value in template.dict().items():
+        setattr(db_template, key, value)
+    db_template.version += 1
+    db.commit()
+    db.refresh(db_template)
+    return db_template
+
 def delete_message_template(db: Session, template_id: int):
     db_template = db.query(models.MessageTemplate).filter(models.MessageTemplate.id == template_id).first()
     if db_template:
@@ -206,3 +412,127 @@ def delete_message_template(db: Session, template_id: int):
         db.commit()
         return True
     return False
+
+def create_delivery_job(db: Session, channel: str, subject: str, body: str, priority: int = 1, due_at: Optional[datetime] = None, template_id: Optional[int] = None, template_version: Optional[int] = None):
+    db_job = models.DeliveryJob(
+        channel=channel, subject=subject, body=body, priority=priority, due_at=due_at or datetime.utcnow(),
+        template_id=template_id, template_version=template_version, status="queued"
+    )
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def get_delivery_job(db: Session, job_id: int):
+    return db.query(models.DeliveryJob).filter(models.DeliveryJob.id == job_id).first()
+
+def claim_delivery_job(db: Session, claimed_by: Optional[str] = None):
+    # Most urgent due job first, oldest first within a lane. Compare-and-set on
+    # status so that two workers never pick up the same job
+    while True:
+        db_job = db.query(models.DeliveryJob).from_statement(DUE_JOB_QUERY).params(now=datetime.utcnow()).first()
+        if not db_job:
+            return None
+        claimed = db.query(models.DeliveryJob).filter(
+            models.DeliveryJob.id == db_job.id,
+            models.DeliveryJob.status == "queued"
+        ).update({"status": "running", "started_at": datetime.utcnow(), "claimed_by": claimed_by}, synchronize_session=False)
+        db.commit()
+        if claimed:
+            db.refresh(db_job)
+            return db_job
+
+def get_next_due_at(db: Session):
+    return db.execute(NEXT_DUE_AT_QUERY).scalar()
+
+def update_delivery_job(db: Session, db_job: models.DeliveryJob, **fields):
+    for key, value in fields.items():
+        setattr(db_job, key, value)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def finish_delivery_job(db: Session, db_job: models.DeliveryJob, error: Optional[str] = None):
+    db_job.status = "failed" if error or db_job.failed else "completed"
+    db_job.error = error or db_job.error
+    db_job.finished_at = datetime.utcnow()
+    # History records what was delivered, in the same transaction as the outcome
+    if db_job.sent:
+        db.add(models.SentMessage(
+            subject=db_job.subject, body=db_job.body,
+            services=f"{db_job.channel}({db_job.sent})", timestamp=db_job.finished_at,
+        ))
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def record_delivery_progress(db: Session, db_job: models.DeliveryJob, attempts: list, **fields):
+    # Attempt rows go in with one executemany, committed together with the job's progress
+    if attempts:
+        db.execute(insert(models.DeliveryAttempt), attempts)
+    return update_delivery_job(db, db_job, **fields)
+
+def get_delivery_stats(db: Session, since: datetime):
+    # Nearest-rank percentiles: the smallest latency whose rank reaches p * count
+    rows = db.execute(text("""
+        WITH ranked AS (
+            SELECT channel, status, latency_ms,
+                   ROW_NUMBER() OVER (PARTITION BY channel ORDER BY latency_ms) AS latency_rank,
+                   COUNT(*) OVER (PARTITION BY channel) AS attempts
+            FROM delivery_attempts
+            WHERE created_at >= :since
+        )
+        SELECT channel,
+               COUNT(*) AS attempts,
+               SUM(status = 'sent') AS sent,
+               SUM(status != 'sent') AS failed,
+               AVG(status = 'sent') AS success_rate,
+               MIN(CASE WHEN latency_rank >= 0.50 * attempts THEN latency_ms END) AS p50_latency_ms,
+               MIN(CASE WHEN latency_rank >= 0.95 * attempts THEN latency_ms END) AS p95_latency_ms
+        FROM ranked
+        GROUP BY channel
+        ORDER BY channel
+    """).bindparams(bindparam("since", type_=DateTime)), {"since": since})
+    return [dict(row._mapping) for row in rows]
+
+def requeue_running_delivery_jobs(db: Session, is_owner_alive):
+    # Jobs left running by a process that has since exited never finished; hand
+    # them back to the queue. Jobs owned by live processes are left alone
+    owners = {row.claimed_by for row in db.query(models.DeliveryJob.claimed_by).filter(models.DeliveryJob.status == "running").distinct()}
+    dead = [owner for owner in owners if owner is not None and not is_owner_alive(owner)]
+    interrupted = [row.id for row in db.query(models.DeliveryJob.id).filter(
+        models.DeliveryJob.status == "running",
+        models.DeliveryJob.claimed_by.is_(None) | models.DeliveryJob.claimed_by.in_(dead)
+    )]
+    if not interrupted:
+        return 0
+    # The job resumes from its delivery log: targets with a sent attempt are
+    # skipped, everything else is tried again, so counters restart from the log
+    db.query(models.DeliveryAttempt).filter(
+        models.DeliveryAttempt.job_id.in_(interrupted), models.DeliveryAttempt.status != "sent"
+    ).delete(synchronize_session=False)
+    sent = select(func.count()).where(
+        models.DeliveryAttempt.job_id == models.DeliveryJob.id, models.DeliveryAttempt.status == "sent"
+    ).scalar_subquery()
+    db.query(models.DeliveryJob).filter(models.DeliveryJob.id.in_(interrupted)).update(
+        {"status": "queued", "started_at": None, "claimed_by": None, "sent": sent, "failed": 0, "error": None},
+        synchronize_session=False,
+    )
+    db.commit()
+    return len(interrupted)
+
+def get_delivered_targets(db: Session, job_id: int):
+    """Targets a job already delivered to, from its delivery log."""
+    return {row.target for row in db.query(models.DeliveryAttempt.target).filter(
+        models.DeliveryAttempt.job_id == job_id, models.DeliveryAttempt.status == "sent"
+    )}
+
+def create_tautulli_sync_run(db: Session, **fields):
+    db_run = models.TautulliSyncRun(**fields)
+    db.add(db_run)
+    db.commit()
+    db.refresh(db_run)
+    return db_run
+
+def get_tautulli_sync_runs(db: Session, limit: int = 10):
+    return db.query(models.TautulliSyncRun).order_by(models.TautulliSyncRun.id.desc()).limit(limit).all()
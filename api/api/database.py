@@ -1,17 +1,80 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from . import profiler
 
-CONFIG_DIR = "./api/config"
+CONFIG_DIR = os.getenv("CONFIG_DIR", "./api/config")
 DATABASE_URL = f"sqlite:///{CONFIG_DIR}/NotifyAgent.db"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{CONFIG_DIR}/NotifyAgent.db"
+
+# SQLite tuning, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # milliseconds
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))  # negative means KiB
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))  # bytes
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
 
 # Ensure the config directory exists
 if not os.path.exists(CONFIG_DIR):
     os.makedirs(CONFIG_DIR)
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+SQLITE_PRAGMAS = {
+    # WAL lets readers run alongside the single writer; NORMAL is durable in WAL mode
+    "journal_mode": SQLITE_JOURNAL_MODE,
+    "synchronous": SQLITE_SYNCHRONOUS,
+    # Wait for the write lock instead of failing with "database is locked"
+    "busy_timeout": SQLITE_BUSY_TIMEOUT,
+    "cache_size": SQLITE_CACHE_SIZE,
+    "mmap_size": SQLITE_MMAP_SIZE,
+}
+
+def apply_pragmas(db_engine, pragmas):
+    @event.listens_for(db_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+def create_db_engine(url=DATABASE_URL, pragmas=SQLITE_PRAGMAS, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT):
+    db_engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+    )
+    apply_pragmas(db_engine, pragmas)
+    return db_engine
+
+def create_async_db_engine(url=ASYNC_DATABASE_URL, pragmas=SQLITE_PRAGMAS, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT):
+    db_engine = create_async_engine(
+        url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+    )
+    # Pragmas are set through the sync facade, which sees every new aiosqlite connection
+    apply_pragmas(db_engine.sync_engine, pragmas)
+    return db_engine
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_db_engine()
+# Objects stay readable after commit, since async sessions can't lazy-load expired attributes
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+if profiler.ENABLED:
+    profiler.install(engine)
+    profiler.install(async_engine.sync_engine)
 Base = declarative_base()
 
 # Database dependency
@@ -20,4 +83,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Async database dependency, for routes that run on the event loop
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
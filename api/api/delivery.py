@@ -0,0 +1,214 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from . import crud, config_cache, coordination, models, templates
+from .database import SessionLocal
+
+# Number of concurrent delivery workers draining the queue
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "2"))
+# How often idle workers re-check the queue for jobs enqueued by other processes
+DELIVERY_POLL_INTERVAL = float(os.getenv("DELIVERY_POLL_INTERVAL", "5"))
+# Recipients read from the database per page when streaming the email list
+RECIPIENT_CHUNK_SIZE = int(os.getenv("RECIPIENT_CHUNK_SIZE", "500"))
+
+class DeliveryError(Exception):
+    pass
+
+_loop = None
+_wakeup = None
+_workers = []
+
+def attempt_row(job, target, status, elapsed, error=None):
+    return {
+        "job_id": job.id,
+        "channel": job.channel,
+        "target": target,
+        "status": status,
+        "latency_ms": elapsed * 1000,
+        "error": error,
+        "created_at": datetime.utcnow(),
+    }
+
+def _skip_delivered(recipient_chunks, delivered, address=lambda recipient: recipient):
+    for chunk in recipient_chunks:
+        chunk = [recipient for recipient in chunk if address(recipient) not in delivered]
+        if chunk:
+            yield chunk
+
+def process_email_job(db, job):
+    # SMTP and MIME support is loaded with the first email job, not at startup
+    from . import mailer
+    config = config_cache.get_snapshot()
+    if not config.email_address:
+        raise DeliveryError("Email credentials not found")
+    crud.update_delivery_job(db, job, total=crud.count_emails(db))
+    # A job resumed after its worker died only sends to recipients it hasn't reached yet
+    delivered = crud.get_delivered_targets(db, job.id) if job.sent else set()
+
+    def on_batch_done(recipients, error, elapsed, refused):
+        # Every recipient of a batch shares the batch's latency; refused addresses fail on their own
+        attempts = []
+        for recipient in recipients:
+            if error:
+                attempts.append(attempt_row(job, recipient, "failed", elapsed, f"Failed to send email: {error}"))
+            elif recipient in refused:
+                attempts.append(attempt_row(job, recipient, "failed", elapsed, f"Recipient refused: {mailer.refusal_error(refused[recipient])}"))
+            else:
+                attempts.append(attempt_row(job, recipient, "sent", elapsed))
+        failed = len(recipients) if error else len(refused)
+        fields = {"sent": job.sent + len(recipients) - failed, "failed": job.failed + failed}
+        if error:
+            fields["error"] = f"Failed to send email: {error}"
+        elif refused:
+            fields["error"] = f"SMTP server refused {len(refused)} recipient(s)"
+        crud.record_delivery_progress(db, job, attempts, **fields)
+
+    pool = mailer.get_pool(config.email_address, config.email_password)
+    template = templates.compile_template(job.subject, job.body, job.template_id, job.template_version)
+    if not template.is_personalized:
+        # One message for everyone, sent to whole batches at once
+        subject, body = template.render({"server_name": templates.SERVER_NAME})
+        recipient_chunks = _skip_delivered(crud.iter_email_chunks(db, chunk_size=RECIPIENT_CHUNK_SIZE), delivered)
+        mailer.send_broadcast(pool, config.email_address, recipient_chunks, subject, body, on_batch_done=on_batch_done)
+        return
+
+    def personalize(recipients):
+        rendered = template.render_batch(recipients)
+        return [(recipient.email, subject, body) for recipient, (subject, body) in zip(recipients, rendered)]
+
+    recipient_chunks = _skip_delivered(crud.iter_recipient_chunks(db, chunk_size=RECIPIENT_CHUNK_SIZE), delivered, lambda recipient: recipient.email)
+    mailer.send_broadcast(pool, config.email_address, recipient_chunks, None, None, on_batch_done=on_batch_done, personalize=personalize)
+
+async def process_discord_job(db, job):
+    from . import discord
+    # Only touches the database when the snapshot has been invalidated
+    config = await asyncio.to_thread(config_cache.get_snapshot)
+    await asyncio.to_thread(crud.update_delivery_job, db, job, total=len(config.active_webhooks))
+    webhooks = config.active_webhooks
+    if job.sent:
+        # Resumed after its worker died: skip the channels it already posted to
+        delivered = await asyncio.to_thread(crud.get_delivered_targets, db, job.id)
+        webhooks = [(channel_name, webhook_url) for channel_name, webhook_url in webhooks if channel_name not in delivered]
+
+    # Discord gets one message for everyone, so only shared variables are filled in
+    payload = discord.build_payload(templates.render_shared(job.subject), templates.render_shared(job.body), config.role_mentions)
+    results = await discord.fan_out(webhooks, payload)
+
+    failures = [result for result in results if not result.ok]
+    for result in failures:
+        print(f"Discord delivery to '{result.channel_name}' failed: {result.error}")
+    fields = {"sent": job.sent + len(results) - len(failures), "failed": job.failed + len(failures)}
+    if failures:
+        fields["error"] = "; ".join(f"{result.channel_name}: {result.error}" for result in failures)
+    attempts = [
+        attempt_row(job, result.channel_name, "sent" if result.ok else "failed", result.elapsed, result.error)
+        for result in results
+    ]
+    await asyncio.to_thread(crud.record_delivery_progress, db, job, attempts, **fields)
+
+JOB_PROCESSORS = {
+    "email": process_email_job,
+    "discord": process_discord_job,
+}
+
+async def run_next_job():
+    """Claim one queued job and deliver it. Returns False when the queue is empty."""
+    db = SessionLocal()
+    try:
+        job = await asyncio.to_thread(crud.claim_delivery_job, db, coordination.PROCESS_ID)
+        if not job:
+            return False
+        processor = JOB_PROCESSORS[job.channel]
+        try:
+            if asyncio.iscoroutinefunction(processor):
+                await processor(db, job)
+            else:
+                await asyncio.to_thread(processor, db, job)
+        except Exception as e:
+            print(f"Delivery job {job.id} ({job.channel}) failed: {e}")
+            await asyncio.to_thread(fail_job, db, job, str(e))
+        else:
+            await asyncio.to_thread(crud.finish_delivery_job, db, job)
+        return True
+    finally:
+        db.close()
+
+def fail_job(db, job, error):
+    db.rollback()
+    crud.finish_delivery_job(db, job, error=error)
+
+def enqueue_job(db, channel, subject, body, template=None, priority="normal", send_at=None):
+    template_fields = {"template_id": template.id, "template_version": template.version} if template else {}
+    if send_at is not None and send_at.tzinfo is not None:
+        send_at = send_at.astimezone(timezone.utc).replace(tzinfo=None)
+    job = crud.create_delivery_job(
+        db, channel=channel, subject=subject, body=body,
+        priority=models.PRIORITY_LANES.index(priority), due_at=send_at, **template_fields
+    )
+    notify_workers()
+    return job
+
+def seconds_until_next_job():
+    """Time until the earliest queued job is due, capped at DELIVERY_POLL_INTERVAL."""
+    db = SessionLocal()
+    try:
+        due_at = crud.get_next_due_at(db)
+    finally:
+        db.close()
+    if due_at is None:
+        return DELIVERY_POLL_INTERVAL
+    return min(max((due_at - datetime.utcnow()).total_seconds(), 0), DELIVERY_POLL_INTERVAL)
+
+def notify_workers():
+    # Enqueue runs on the request threadpool, the workers live on the event loop
+    if _loop is not None and _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+async def _worker():
+    while True:
+        _wakeup.clear()
+        try:
+            found = await run_next_job()
+        except Exception as e:
+            print(f"Delivery worker error: {e}")
+            found = False
+        if not found:
+            # Sleep until the next scheduled job is due, or a new job is enqueued
+            try:
+                timeout = await asyncio.to_thread(seconds_until_next_job)
+                await asyncio.wait_for(_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                print(f"Delivery worker error: {e}")
+                await asyncio.sleep(DELIVERY_POLL_INTERVAL)
+
+async def start_workers():
+    global _loop, _wakeup
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+
+    db = SessionLocal()
+    try:
+        requeued = crud.requeue_running_delivery_jobs(db, coordination.is_process_alive)
+        if requeued:
+            print(f"Requeued {requeued} interrupted delivery job(s)")
+    finally:
+        db.close()
+
+    for _ in range(DELIVERY_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    # Only close the integrations that were loaded
+    mailer = sys.modules.get(f"{__package__}.mailer")
+    if mailer is not None:
+        mailer.close_pool()
+    discord = sys.modules.get(f"{__package__}.discord")
+    if discord is not None:
+        await discord.close_client()
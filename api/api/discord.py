@@ -0,0 +1,226 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+import httpx
+from . import coordination, metrics
+
+# Maximum number of webhook posts in flight at once
+DISCORD_CONCURRENCY = int(os.getenv("DISCORD_CONCURRENCY", "10"))
+DISCORD_TIMEOUT = float(os.getenv("DISCORD_TIMEOUT", "15"))
+# Attempts after a 429 before a webhook is reported as failed
+DISCORD_MAX_RETRIES = int(os.getenv("DISCORD_MAX_RETRIES", "3"))
+# Discord's global limit is 50 requests per second across all routes
+DISCORD_GLOBAL_RATE = int(os.getenv("DISCORD_GLOBAL_RATE", "50"))
+
+_client = None
+
+@dataclass
+class WebhookResult:
+    channel_name: str
+    ok: bool
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    retries: int = 0
+
+def _number(value):
+    """A rate-limit header or body value as seconds, or None when it isn't a number."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number >= 0 and number != float("inf") else None
+
+RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS discord_buckets (key TEXT PRIMARY KEY, remaining INTEGER NOT NULL, reset_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS discord_requests (namespace TEXT NOT NULL, sent_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_discord_requests_sent_at ON discord_requests (namespace, sent_at);
+"""
+# Bucket row holding the end of a global 429; webhook buckets are keyed by URL
+GLOBAL_BUCKET = "global"
+
+class RateLimiter:
+    """
+    Schedules webhook posts around Discord's rate limits. Each webhook has
+    its own bucket, refreshed from the X-RateLimit-Remaining and
+    X-RateLimit-Reset-After headers; a 429 blocks the webhook (or everything,
+    for a global 429) until Retry-After has passed. Posts to the same webhook
+    are serialized so concurrent broadcasts share its bucket correctly.
+
+    Buckets, the global block and the global request window live in
+    coordination.SharedState, so every API worker sees the limits the others
+    ran into. `namespace` keeps separate limiters (tests) from sharing them.
+    """
+
+    def __init__(self, global_rate=DISCORD_GLOBAL_RATE, namespace="discord"):
+        self.global_rate = global_rate
+        self.namespace = namespace
+        self._state = coordination.SharedState(RATE_LIMIT_SCHEMA)
+        self._locks = {}
+        self.delayed = 0
+        self.retried = 0
+
+    def lock(self, key):
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+
+    def _bucket_key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _delay_locked(self, db, key, now):
+        delay = 0.0
+        row = db.execute("SELECT reset_at FROM discord_buckets WHERE key = ?", (self._bucket_key(GLOBAL_BUCKET),)).fetchone()
+        if row:
+            delay = row[0] - now
+        row = db.execute("SELECT remaining, reset_at FROM discord_buckets WHERE key = ?", (self._bucket_key(key),)).fetchone()
+        if row and row[0] <= 0:
+            delay = max(delay, row[1] - now)
+        # Sliding one-second window for the global request rate
+        db.execute("DELETE FROM discord_requests WHERE namespace = ? AND sent_at <= ?", (self.namespace, now - 1.0))
+        count, oldest = db.execute("SELECT COUNT(*), MIN(sent_at) FROM discord_requests WHERE namespace = ?", (self.namespace,)).fetchone()
+        if count >= self.global_rate:
+            delay = max(delay, oldest + 1.0 - now)
+        return delay
+
+    def _delay(self, key):
+        with self._state.transaction() as db:
+            return self._delay_locked(db, key, time.time())
+
+    def _reserve(self, key):
+        """Take a request slot for `key` and return 0, or the seconds to wait before asking again."""
+        now = time.time()
+        with self._state.transaction() as db:
+            delay = self._delay_locked(db, key, now)
+            if delay > 0:
+                return delay
+            db.execute("INSERT INTO discord_requests (namespace, sent_at) VALUES (?, ?)", (self.namespace, now))
+            # Count the post against the bucket now, so another worker doesn't spend the same slot
+            db.execute(
+                "UPDATE discord_buckets SET remaining = remaining - 1 WHERE key = ? AND reset_at > ?",
+                (self._bucket_key(key), now),
+            )
+        return 0
+
+    def _set_bucket(self, db, key, remaining, reset_at):
+        db.execute(
+            "INSERT INTO discord_buckets (key, remaining, reset_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET remaining = excluded.remaining, reset_at = excluded.reset_at",
+            (self._bucket_key(key), remaining, reset_at),
+        )
+
+    async def wait(self, key):
+        delay = await asyncio.to_thread(self._reserve, key)
+        if delay > 0:
+            self.delayed += 1
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = await asyncio.to_thread(self._reserve, key)
+
+    def update(self, key, response):
+        """Record the limits reported by `response`. Returns True when it was a 429."""
+        now = time.time()
+        headers = response.headers
+        remaining = _number(headers.get("X-RateLimit-Remaining"))
+        reset_after = _number(headers.get("X-RateLimit-Reset-After"))
+        is_429 = response.status_code == 429
+        if is_429:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            # Anything but an object (a proxy's error page, an array) carries no limits
+            if not isinstance(body, dict):
+                body = {}
+            retry_after = _number(headers.get("Retry-After")) or _number(body.get("retry_after")) or reset_after or 1
+            is_global = headers.get("X-RateLimit-Global") == "true" or body.get("global") is True
+        elif remaining is None or reset_after is None:
+            return False
+
+        with self._state.transaction() as db:
+            if remaining is not None and reset_after is not None:
+                self._set_bucket(db, key, int(remaining), now + reset_after)
+            if is_429 and is_global:
+                row = db.execute("SELECT reset_at FROM discord_buckets WHERE key = ?", (self._bucket_key(GLOBAL_BUCKET),)).fetchone()
+                self._set_bucket(db, GLOBAL_BUCKET, 0, max(row[0] if row else 0.0, now + retry_after))
+            elif is_429:
+                self._set_bucket(db, key, 0, now + retry_after)
+        return is_429
+
+    def stats(self):
+        with self._state.transaction() as db:
+            tracked = db.execute(
+                "SELECT COUNT(*) FROM discord_buckets WHERE substr(key, 1, ?) = ? AND key != ?",
+                (len(self.namespace) + 1, f"{self.namespace}:", self._bucket_key(GLOBAL_BUCKET)),
+            ).fetchone()[0]
+        return {"delayed": self.delayed, "retried": self.retried, "tracked_webhooks": tracked}
+
+rate_limiter = RateLimiter()
+
+def get_client():
+    """Shared keep-alive client so repeated posts to discord.com reuse TCP/TLS connections."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=DISCORD_TIMEOUT,
+            limits=httpx.Limits(max_connections=DISCORD_CONCURRENCY, max_keepalive_connections=DISCORD_CONCURRENCY),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def build_payload(subject, body, mentions):
+    embed = {
+        "title": subject,
+        "description": body,
+        "color": 16753920
+    }
+    return {
+        "content": mentions,
+        "embeds": [embed]
+    }
+
+async def post_webhook(client, channel_name, webhook_url, payload, limiter=None):
+    limiter = limiter or rate_limiter
+    start = time.perf_counter()
+    retries = 0
+    async with limiter.lock(webhook_url):
+        while True:
+            await limiter.wait(webhook_url)
+            try:
+                response = await client.post(webhook_url, json=payload)
+            # InvalidURL isn't an HTTPError; a malformed stored URL fails only its own webhook
+            except (httpx.HTTPError, httpx.InvalidURL) as e:
+                return WebhookResult(channel_name, False, error=str(e) or type(e).__name__, elapsed=time.perf_counter() - start, retries=retries)
+            if not await asyncio.to_thread(limiter.update, webhook_url, response) or retries >= DISCORD_MAX_RETRIES:
+                break
+            retries += 1
+            limiter.retried += 1
+    elapsed = time.perf_counter() - start
+    if response.status_code != 204:
+        return WebhookResult(channel_name, False, response.status_code, f"Failed to send message to Discord channel: {response.status_code}", elapsed, retries)
+    return WebhookResult(channel_name, True, response.status_code, elapsed=elapsed, retries=retries)
+
+async def fan_out(webhooks, payload, concurrency=DISCORD_CONCURRENCY):
+    """
+    Post `payload` to every (channel_name, webhook_url) pair concurrently.
+    Returns one WebhookResult per webhook, in input order; failures are
+    reported in the results rather than raised.
+    """
+    client = get_client()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(channel_name, webhook_url):
+        async with semaphore:
+            result = await post_webhook(client, channel_name, webhook_url, payload)
+        metrics.discord_webhook_duration.observe(result.elapsed)
+        metrics.discord_webhook_responses.inc(status=result.status_code or "error")
+        return result
+
+    return await asyncio.gather(*(post(channel_name, webhook_url) for channel_name, webhook_url in webhooks))
@@ -0,0 +1,317 @@
+import os
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import html
+import re
+from email import policy
+from email.header import Header
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from . import metrics
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+# Number of authenticated sessions kept open and used in parallel
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+# Providers reject messages with too many envelope recipients (Gmail: 100)
+SMTP_MAX_RECIPIENTS = int(os.getenv("SMTP_MAX_RECIPIENTS", "100"))
+SMTP_BATCH_RETRIES = int(os.getenv("SMTP_BATCH_RETRIES", "2"))
+# Idle sessions older than this are checked with NOOP before being reused
+SMTP_KEEPALIVE_CHECK = float(os.getenv("SMTP_KEEPALIVE_CHECK", "30"))
+
+class SMTPPool:
+    """Keeps up to `size` logged-in SMTP sessions alive for reuse across sends."""
+
+    def __init__(self, username, password, host=SMTP_HOST, port=SMTP_PORT, size=SMTP_POOL_SIZE, starttls=SMTP_STARTTLS):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.size = size
+        self.starttls = starttls
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        operation = "connect"
+        start = time.perf_counter()
+        server = None
+        try:
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if self.starttls:
+                server.starttls()
+            server.ehlo_or_helo_if_needed()
+            metrics.smtp_duration.observe(time.perf_counter() - start, operation=operation)
+            # Local relays and test sinks don't offer AUTH; send unauthenticated there
+            if self.username and server.has_extn("auth"):
+                operation = "login"
+                with metrics.smtp_duration.time(operation=operation):
+                    server.login(self.username, self.password)
+        except Exception:
+            metrics.smtp_errors.inc(operation=operation)
+            if server is not None:
+                _close(server)
+            raise
+        return server
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            if time.monotonic() - last_used < SMTP_KEEPALIVE_CHECK:
+                return server
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except smtplib.SMTPException:
+                pass
+            _close(server)
+        return self._connect()
+
+    @contextmanager
+    def session(self):
+        self._slots.acquire()
+        try:
+            server = self._checkout()
+            try:
+                yield server
+            except Exception:
+                # The session state is unknown after a failure, don't hand it out again
+                _close(server)
+                raise
+            with self._lock:
+                self._idle.append((server, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            _close(server)
+
+def _close(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def get_pool(username, password):
+    """Return the shared pool, replacing it when the stored credentials change."""
+    global _pool, _pool_key
+    key = (SMTP_HOST, SMTP_PORT, username, password)
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool is not None:
+                _pool.close()
+            _pool = SMTPPool(username, password)
+            _pool_key = key
+        return _pool
+
+def close_pool():
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+        _pool_key = None
+
+def iter_batches(recipient_chunks, batch_size=SMTP_MAX_RECIPIENTS):
+    batch = []
+    for chunk in recipient_chunks:
+        for recipient in chunk:
+            batch.append(recipient)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def html_to_text(body):
+    # Plain-text alternative: drop any markup the author typed into the body
+    text = re.sub(r"<br\s*/?>", "\n", body, flags=re.IGNORECASE)
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+def build_message(sender, subject, body, images=None):
+    """
+    Build a multipart/alternative message with a plain-text part and an HTML
+    part. `images` maps a Content-ID to image bytes; those are attached inline
+    next to the HTML, which references them as "cid:<id>".
+    """
+    msg = MIMEMultipart('alternative')
+    msg['From'] = sender
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html_to_text(body), 'plain', 'utf-8'))
+
+    # Convert newlines to <br> tags for HTML formatting
+    html_part = MIMEText(body.replace('\n', '<br>'), 'html', 'utf-8')
+    if images:
+        related = MIMEMultipart('related')
+        related.attach(html_part)
+        for content_id, data in images.items():
+            image = MIMEImage(data)
+            image.add_header('Content-ID', f'<{content_id}>')
+            image.add_header('Content-Disposition', 'inline', filename=content_id)
+            related.attach(image)
+        html_part = related
+    msg.attach(html_part)
+    return msg
+
+class PreparedMessage:
+    """
+    A message whose headers and MIME body are encoded once. Envelopes only
+    differ in their To header, so each batch of a broadcast reuses the same
+    bytes instead of rebuilding and re-serializing the whole message.
+    """
+
+    def __init__(self, sender, subject, body, images=None):
+        data = build_message(sender, subject, body, images).as_bytes(policy=policy.SMTP)
+        self._headers, self._body = data.split(b"\r\n\r\n", 1)
+        self._last = (None, None)
+
+    def envelope(self, to):
+        last_to, data = self._last
+        if last_to != to:
+            header = to if to.isascii() else Header(to, 'utf-8').encode()
+            data = b"".join((self._headers, b"\r\nTo: ", header.encode("ascii"), b"\r\n\r\n", self._body))
+            self._last = (to, data)
+        return data
+
+def _sendmail(server, sender, recipients, data):
+    """Send `data` and return the recipients the server refused, as {address: (code, message)}."""
+    start = time.perf_counter()
+    try:
+        refused = server.sendmail(sender, recipients, data)
+    except smtplib.SMTPRecipientsRefused as e:
+        # Every recipient was refused; the session itself is still usable
+        refused = e.recipients
+    except Exception:
+        metrics.smtp_errors.inc(operation="send")
+        raise
+    metrics.smtp_duration.observe(time.perf_counter() - start, operation="send")
+    if refused:
+        metrics.smtp_errors.inc(len(refused), operation="recipient")
+    return refused
+
+def refusal_error(refusal):
+    code, message = refusal
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    return f"{code} {message}"
+
+def send_batch(pool, sender, recipients, message, retries=SMTP_BATCH_RETRIES):
+    """
+    Send one PreparedMessage to a batch of envelope recipients, Bcc-style.
+    Returns the recipients the server refused, as {address: (code, message)}.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with pool.session() as server:
+                return _sendmail(server, sender, recipients, message.envelope(sender))
+        except smtplib.SMTPAuthenticationError:
+            raise
+        except (smtplib.SMTPException, OSError) as e:
+            if attempt == retries:
+                raise
+            print(f"SMTP batch of {len(recipients)} failed ({e}), retrying")
+            time.sleep(min(2 ** attempt, 10))
+
+def send_messages(pool, sender, messages, retries=SMTP_BATCH_RETRIES):
+    """
+    Send individual (recipient, subject, body) messages over a single session.
+    Returns the recipients the server refused, as {address: (code, message)}.
+    """
+    pending = list(messages)
+    refused = {}
+    for attempt in range(retries + 1):
+        try:
+            with pool.session() as server:
+                while pending:
+                    recipient, subject, body = pending[0]
+                    refused.update(_sendmail(server, sender, [recipient], PreparedMessage(sender, subject, body).envelope(recipient)))
+                    pending.pop(0)
+            return refused
+        except smtplib.SMTPAuthenticationError:
+            raise
+        except (smtplib.SMTPException, OSError) as e:
+            if attempt == retries:
+                raise
+            # Messages already accepted are not sent again
+            print(f"SMTP session failed with {len(pending)} messages left ({e}), retrying")
+            time.sleep(min(2 ** attempt, 10))
+
+def _send_timed(send, *args):
+    start = time.perf_counter()
+    try:
+        refused = send(*args)
+    except Exception as e:
+        return {}, e, time.perf_counter() - start
+    return refused, None, time.perf_counter() - start
+
+def send_broadcast(pool, sender, recipient_chunks, subject, body, on_batch_done=None, personalize=None):
+    """
+    Split recipients into batches under SMTP_MAX_RECIPIENTS and send them over
+    the pool's parallel sessions. `on_batch_done(recipients, error, elapsed,
+    refused)` runs on the calling thread, so it may safely use the caller's
+    database session; `refused` maps the addresses the server rejected in an
+    otherwise accepted batch to their (code, message).
+
+    With `personalize`, each batch is passed to it and must come back as a
+    list of (recipient, subject, body); every recipient then gets their own
+    message and `subject`/`body` are unused.
+    """
+    # Shared by every batch: the message is encoded once per broadcast
+    message = PreparedMessage(sender, subject, body) if not personalize else None
+    sent = failed = 0
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        pending = {}
+
+        def collect(done):
+            nonlocal sent, failed
+            for future in done:
+                recipients = pending.pop(future)
+                refused, error, elapsed = future.result()
+                if error:
+                    failed += len(recipients)
+                    print(f"SMTP batch of {len(recipients)} recipients failed: {error}")
+                else:
+                    sent += len(recipients) - len(refused)
+                    failed += len(refused)
+                    if refused:
+                        print(f"SMTP server refused {len(refused)} of {len(recipients)} recipients")
+                if on_batch_done:
+                    on_batch_done(recipients, error, elapsed, refused)
+
+        # Recipient chunks are read lazily, so keep a bounded number of batches in flight
+        for recipients in iter_batches(recipient_chunks):
+            if len(pending) >= pool.size * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            if personalize:
+                messages = personalize(recipients)
+                future = executor.submit(_send_timed, send_messages, pool, sender, messages)
+                recipients = [recipient for recipient, _, _ in messages]
+            else:
+                future = executor.submit(_send_timed, send_batch, pool, sender, recipients, message)
+            pending[future] = recipients
+
+        if pending:
+            done, _ = wait(pending)
+            collect(done)
+    return sent, failed
@@ -1,34 +1,33 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+import asyncio
+import base64
+import math
 import os
-import smtplib
-import requests
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta, datetime
-from jose import JWTError, jwt
-from . import models, schemas, crud
-from .database import SessionLocal, engine, get_db
-from .auth import create_access_token, get_current_user, get_current_active_user, get_admin_user, ACCESS_TOKEN_EXPIRE_MINUTES, get_password_hash, verify_password, oauth2_scheme, SECRET_KEY, ALGORITHM
-
-app = FastAPI(root_path="/api")
+from . import models, schemas, crud, async_crud, config_cache, coordination, delivery, metrics, migrations, profiler, retention, tautulli, templates
+from .database import SessionLocal, engine, async_engine, get_db, get_async_db
+from .auth import create_access_token, get_verified_token, get_current_user, get_current_active_user, get_admin_user, ACCESS_TOKEN_EXPIRE_MINUTES, get_password_hash, verify_password_async, login_throttle
 
 load_dotenv()
 
-models.Base.metadata.create_all(bind=engine)
+# Characters of the body returned per message by the paginated history list
+HISTORY_PREVIEW_LENGTH = int(os.getenv("HISTORY_PREVIEW_LENGTH", "200"))
 
 # Function moved from auth.py to fix circular imports
-def authenticate_user(db: Session, username: str, password: str):
-    user = crud.get_user_by_username(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await async_crud.get_user_by_username(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    if not await verify_password_async(password, user.password_hash):
         return False
     return user
 
@@ -49,13 +48,55 @@ def create_admin_user():
             db.commit()
             print(f"Admin user '{admin_username}' created successfully!")
     except Exception as e:
+        db.rollback()
         print(f"Error creating admin user: {e}")
+        # Fail startup rather than come up with nobody able to log in
+        raise
     finally:
         db.close()
 
-# Create admin user on startup
-create_admin_user()
+def initialize_database():
+    # Every worker process runs this at startup; the lock makes the others wait
+    # until the first has applied migrations and seeded the admin user. Migrations
+    # are skipped once the schema version is current, but the user check is cheap
+    # and always runs, so a seeding that failed after a migration is retried
+    with coordination.file_lock("startup"):
+        migrations.run_migrations(engine)
+        create_admin_user()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    coordination.register_process()
+    await asyncio.to_thread(initialize_database)
+    await delivery.start_workers()
+    tautulli.start_sync_scheduler()
+    retention.start_archive_scheduler()
+    metrics.start_flusher()
+    yield
+    await metrics.stop_flusher()
+    await tautulli.stop_sync_scheduler()
+    await retention.stop_archive_scheduler()
+    await delivery.stop_workers()
+    await async_engine.dispose()
+    coordination.unregister_process()
+
+app = FastAPI(root_path="/api", lifespan=lifespan)
+
+# Statement counts for /metrics, from both the sync and the async engine
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+metrics.Gauge(
+    "notifyagent_cache_hit_ratio", "Share of lookups served from the in-process caches, across all workers.",
+    lambda: {
+        ("user",): metrics.hit_ratio(metrics.user_cache_lookups.value(result="hit"), metrics.user_cache_lookups.value(result="miss")),
+        ("config",): metrics.hit_ratio(metrics.config_cache_lookups.value(result="hit"), metrics.config_cache_lookups.value(result="miss")),
+    },
+    ("cache",),
+)
 
+app.add_middleware(metrics.MetricsMiddleware)
+if profiler.ENABLED:
+    app.add_middleware(profiler.ProfilerMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -66,14 +107,26 @@ app.add_middleware(
 
 # Authentication routes
 @app.post("/login/", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    # nginx forwards the real client address; fall back to the socket peer when called directly
+    client_ip = request.headers.get("X-Real-IP") or (request.client.host if request.client else "unknown")
+    # The throttle's state is shared with the other workers through a file, so keep it off the event loop
+    retry_after = await asyncio.to_thread(login_throttle.check, form_data.username, client_ip)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    await asyncio.to_thread(login_throttle.reset_user, form_data.username)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
     # Calculate expiry timestamp in milliseconds for frontend
@@ -100,38 +153,31 @@ async def refresh_token(current_user = Depends(get_current_user)):
     return {"token": access_token, "username": current_user.username, "expires_at": expiry_ms}
 
 @app.get("/verify-token/")
-async def verify_token(current_user = Depends(get_current_user), token: str = Depends(oauth2_scheme)):
-    try:
-        # Decode token to get expiry time
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        exp = payload.get("exp")
-        
-        # Calculate expiry time in milliseconds (for frontend)
-        expiry_ms = int(exp) * 1000 if exp else None
-        
-        return {
-            "valid": True, 
-            "username": current_user.username,
-            "expiry": expiry_ms
-        }
-    except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+async def verify_token(verified = Depends(get_verified_token)):
+    # Claims come from the same (cached) verification as the user, no second decode
+    payload, current_user = verified
+    exp = payload.get("exp")
+
+    # Calculate expiry time in milliseconds (for frontend)
+    expiry_ms = int(exp) * 1000 if exp else None
+
+    return {
+        "valid": True,
+        "username": current_user.username,
+        "expiry": expiry_ms
+    }
 
 # User management routes
 @app.post("/users/", response_model=schemas.User)
-async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db), admin_user = Depends(get_admin_user)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db), admin_user = Depends(get_admin_user)):
+    db_user = await async_crud.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    return await async_crud.create_user(db=db, user=user)
 
 @app.get("/users/", response_model=List[schemas.User])
-async def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), admin_user = Depends(get_admin_user)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+async def read_users(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db), admin_user = Depends(get_admin_user)):
+    users = await async_crud.get_users(db, skip=skip, limit=limit)
     return users
 
 @app.get("/users/me/", response_model=schemas.User)
@@ -139,108 +185,94 @@ async def read_user_me(current_user = Depends(get_current_active_user)):
     return current_user
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-async def read_user(user_id: int, db: Session = Depends(get_db), admin_user = Depends(get_admin_user)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user(user_id: int, db: AsyncSession = Depends(get_async_db), admin_user = Depends(get_admin_user)):
+    db_user = await async_crud.get_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.put("/users/{user_id}", response_model=schemas.User)
-async def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db), admin_user = Depends(get_admin_user)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def update_user(user_id: int, user: schemas.UserUpdate, db: AsyncSession = Depends(get_async_db), admin_user = Depends(get_admin_user)):
+    db_user = await async_crud.get_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.update_user(db=db, user_id=user_id, user=user)
+    return await async_crud.update_user(db=db, user_id=user_id, user=user)
 
 @app.delete("/users/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(get_db), admin_user = Depends(get_admin_user)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_async_db), admin_user = Depends(get_admin_user)):
+    db_user = await async_crud.get_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check if this is the only admin user
     if db_user.is_admin:
-        admin_count = db.query(models.User).filter(models.User.is_admin == True).count()
+        admin_count = await async_crud.count_admin_users(db)
         if admin_count <= 1:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST, 
                 detail="Cannot delete the only admin user. Create another admin user first."
             )
     
-    result = crud.delete_user(db=db, user_id=user_id)
+    result = await async_crud.delete_user(db=db, user_id=user_id)
     if result:
         return {"detail": "User deleted successfully"}
     raise HTTPException(status_code=500, detail="Failed to delete user")
 
-# Load environment variables
-EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
-EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
-
-# Function to send email
-def send_email_bcc(db: Session, recipients, subject, body):
-    # Fetch email credentials from the database
-    credentials = crud.get_email_credentials(db)
-    print(f"Email credentials: {credentials.email_address, credentials.email_password}")
-    if not credentials:
-        raise HTTPException(status_code=404, detail="Email credentials not found")
-
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(credentials.email_address, credentials.email_password)
-
-        msg = MIMEMultipart()
-        msg['From'] = credentials.email_address
-        msg['To'] = credentials.email_address
-        msg['Subject'] = subject
-        
-        # Convert newlines to <br> tags for HTML formatting
-        html_body = body.replace('\n', '<br>')
-
-        msg.attach(MIMEText(html_body, 'html'))
-
-        msg['Bcc'] = ', '.join(recipients)
-        server.send_message(msg)
-        server.quit()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {e}")
-
-# Function to send Discord message
-def send_discord_message(subject, body, webhook_url, role_mentions):
-    embed = {
-        "title": subject,
-        "description": body,
-        "color": 16753920
-    }
-    mentions = " ".join([f"<@&{role.role_id}>" for role in role_mentions])
-    data = {
-        "content": mentions,
-        "embeds": [embed]
-    }
-    response = requests.post(webhook_url, json=data)
-    if response.status_code != 204:
-        raise HTTPException(status_code=500, detail=f"Failed to send message to Discord channel: {response.status_code}")
-
 @app.post("/send_email/")
 def send_email(request: models.EmailRequest, db: Session = Depends(get_db)):
-    emails = crud.get_emails(db)
-    recipients = [email.email for email in emails]
-    
-    if not recipients:
+    if not config_cache.get_snapshot().email_address:
+        raise HTTPException(status_code=404, detail="Email credentials not found")
+    if not crud.count_emails(db):
         raise HTTPException(status_code=404, detail="No recipients found")
-    
-    send_email_bcc(db, recipients, request.subject, request.body)
-    return {"message": "Email sent successfully"}
+
+    template = None
+    if request.template_id is not None:
+        template = crud.get_message_template(db, request.template_id)
+        if not template:
+            raise HTTPException(status_code=404, detail="Message template not found")
+    subject, body = request.subject, request.body
+    if template:
+        subject = template.subject if subject is None else subject
+        body = template.body if body is None else body
+        # Overriding the template's text means its cached compilation doesn't apply
+        if (subject, body) != (template.subject, template.body):
+            template = None
+    if subject is None or body is None:
+        raise HTTPException(status_code=400, detail="Subject and body are required without a template")
+    # Only saved templates are checked strictly; in free text an unknown {{ word }} is sent as written
+    if template:
+        try:
+            templates.compile_template(subject, body, template.id, template.version)
+        except templates.TemplateError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    job = delivery.enqueue_job(db, "email", subject, body, template=template, priority=request.priority, send_at=request.send_at)
+    return {"message": "Email queued for delivery", "job_id": job.id}
 
 @app.post("/send_discord/")
 def send_discord(request: models.DiscordRequest, db: Session = Depends(get_db)):
-    webhooks = crud.get_webhooks(db)
-    active_webhooks = [webhook for webhook in webhooks if webhook.is_active]
-    role_mentions = crud.get_discord_roles(db)
-    active_role_mentions = [role for role in role_mentions if role.is_active]
-    for webhook in active_webhooks:
-        send_discord_message(request.subject, request.body, webhook.webhook_url, active_role_mentions)
-    return {"message": "Discord message sent successfully"}
+    job = delivery.enqueue_job(db, "discord", request.subject, request.body, priority=request.priority, send_at=request.send_at)
+    return {"message": "Discord message queued for delivery", "job_id": job.id}
+
+@app.get("/delivery_jobs/{job_id}", response_model=schemas.DeliveryJob)
+def get_delivery_job(job_id: int, db: Session = Depends(get_db)):
+    job = crud.get_delivery_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Delivery job not found")
+    return job
+
+@app.get("/delivery_stats/", response_model=List[schemas.DeliveryChannelStats])
+def get_delivery_stats(hours: float = Query(24, gt=0), db: Session = Depends(get_db)):
+    return crud.get_delivery_stats(db, since=datetime.utcnow() - timedelta(hours=hours))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/discord_rate_limits/")
+def get_discord_rate_limits():
+    from . import discord
+    return discord.rate_limiter.stats()
 
 @app.post("/set_webhook/", response_model=schemas.Webhook)
 def set_webhook(request: models.WebhookRequest, db: Session = Depends(get_db)):
@@ -265,10 +297,7 @@ def update_webhook(webhook: schemas.WebhookUpdate, db: Session = Depends(get_db)
     db_webhook = crud.get_webhook_by_channel_name(db, channel_name=webhook.channel_name)
     if not db_webhook:
         raise HTTPException(status_code=404, detail="Webhook not found")
-    db_webhook.is_active = webhook.is_active
-    db.commit()
-    db.refresh(db_webhook)
-    return db_webhook
+    return crud.update_webhook(db, db_webhook, webhook)
 
 @app.post("/add_email/")
 def add_email(email: schemas.EmailCreate, db: Session = Depends(get_db)):
@@ -298,47 +327,27 @@ def import_emails(db: Session = Depends(get_db)):
     if not credentials:
         raise HTTPException(status_code=404, detail="Tautulli credentials not found")
 
-    url = f"{credentials.base_url}/api/v2"
-    params = {
-        'apikey': credentials.api_key,
-        'cmd': 'get_users'
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
-
-    if data['response']['result'] == 'success':
-        users = data['response']['data']
-        emails = [user['email'] for user in users if user['email']]
-        
-        # Fetch exclusion list
-        exclusion_list = crud.get_exclusion_list(db)
-        exclusion_emails = {exclusion.email for exclusion in exclusion_list}
-
-        # Store emails in the database, excluding those in the exclusion list
-        for email in emails:
-            if email not in exclusion_emails:
-                db_email = crud.get_email_by_address(db, email=email)
-                if not db_email:
-                    print(f"Adding email to database: {email}")
-                    crud.create_email(db=db, email=schemas.EmailCreate(email=email))
-                else:
-                    print(f"Email already in database: {email}")
-            else:
-                print(f"Email excluded: {email}")
-                # Delete email from database if it exists
-                db_email = crud.get_email_by_address(db, email=email)
-                if db_email:
-                    print(f"Deleting email from database: {email}")
-                    crud.delete_email(db=db, email=email)
-        
-        # Fetch the updated list of emails from the database
-        updated_emails = crud.get_emails(db)
-        updated_email_list = [email.email for email in updated_emails]
-        
-        return {"emails": updated_email_list}
-    else:
+    # Store emails in the database, excluding (and removing) those in the exclusion list
+    try:
+        run = tautulli.sync_users(db, trigger="manual", force=True)
+    except tautulli.TautulliError as e:
+        print(f"Tautulli import failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to retrieve users from Tautulli")
-    
+    print(f"Tautulli import: {run['added']} emails added, {run['removed']} excluded emails removed")
+
+    # Fetch the updated list of emails from the database
+    updated_email_list = [email for chunk in crud.iter_email_chunks(db) for email in chunk]
+
+    return {"emails": updated_email_list}
+
+@app.get("/tautulli_sync_status/", response_model=schemas.TautulliSyncStatus)
+def get_tautulli_sync_status(db: Session = Depends(get_db)):
+    return {
+        "interval_minutes": tautulli.TAUTULLI_SYNC_INTERVAL,
+        "last_check": tautulli.get_last_check(),
+        "recent_runs": crud.get_tautulli_sync_runs(db),
+    }
+
 @app.get("/get_emails/", response_model=List[str])
 def get_emails(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     emails = crud.get_emails(db, skip=skip, limit=limit)
@@ -395,11 +404,7 @@ def set_email_credentials(request: schemas.EmailCredentialsCreate, db: Session =
     db_credentials = crud.get_email_credentials(db)
     if db_credentials:
         # Update existing credentials
-        db_credentials.email_address = request.email_address
-        db_credentials.email_password = request.email_password
-        db.commit()
-        db.refresh(db_credentials)
-        return db_credentials
+        return crud.update_email_credentials(db, db_credentials, request)
     else:
         # Create new credentials
         return crud.create_email_credentials(db=db, credentials=request)
@@ -451,6 +456,52 @@ def save_sent_message(request: schemas.SentMessageCreate, db: Session = Depends(
 def get_sent_messages(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     return crud.get_sent_messages(db, skip=skip, limit=limit)
 
+@app.get("/sent_messages/", response_model=schemas.SentMessagePage)
+def list_sent_messages(limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    before = None
+    if cursor:
+        try:
+            timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+            before = (datetime.fromisoformat(timestamp), int(message_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    items = crud.get_sent_message_page(db, limit=limit + 1, before=before, preview_length=HISTORY_PREVIEW_LENGTH)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = base64.urlsafe_b64encode(f"{last['timestamp'].isoformat()}|{last['id']}".encode()).decode()
+    return {"items": items, "next_cursor": next_cursor}
+
+@app.get("/search_sent_messages/", response_model=schemas.SentMessageSearchPage)
+def search_sent_messages(q: str, limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    items = crud.search_sent_messages(db, q, limit=limit + 1, offset=offset)
+    next_offset = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_offset = offset + limit
+    return {"items": items, "next_offset": next_offset}
+
+@app.get("/sent_messages/{message_id}", response_model=schemas.SentMessage)
+def get_sent_message(message_id: int, db: Session = Depends(get_db)):
+    message = crud.get_sent_message(db, message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message
+
+@app.post("/archive_sent_messages/")
+def archive_sent_messages(older_than_days: Optional[float] = Query(None, gt=0), db: Session = Depends(get_db)):
+    days = older_than_days or retention.HISTORY_RETENTION_DAYS
+    if not days:
+        raise HTTPException(status_code=400, detail="No retention period given or configured")
+    archived = retention.archive_sent_messages(db, days)
+    return {"archived": archived}
+
+@app.get("/archived_sent_messages/")
+def get_archived_sent_messages(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    return StreamingResponse(retention.iter_archived_messages(since, until), media_type="application/x-ndjson")
+
 from fastapi import HTTPException
 
 @app.delete("/clear_sent_messages/")
@@ -467,8 +518,23 @@ def get_message_templates(skip: int = 0, limit: int = 100, db: Session = Depends
 
 @app.post("/message_templates/", response_model=schemas.MessageTemplate)
 def create_message_template(template: schemas.MessageTemplateCreate, db: Session = Depends(get_db)):
+    try:
+        templates.compile_template(template.subject, template.body, strict=True)
+    except templates.TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return crud.create_message_template(db=db, template=template)
 
+@app.put("/message_templates/{template_id}", response_model=schemas.MessageTemplate)
+def update_message_template(template_id: int, template: schemas.MessageTemplateCreate, db: Session = Depends(get_db)):
+    db_template = crud.get_message_template(db, template_id)
+    if not db_template:
+        raise HTTPException(status_code=404, detail="Message template not found")
+    try:
+        templates.compile_template(template.subject, template.body, strict=True)
+    except templates.TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return crud.update_message_template(db, db_template, template)
+
 @app.delete("/message_templates/{template_id}", response_model=bool)
 def delete_message_template(template_id: int, db: Session = Depends(get_db)):
     return crud.delete_message_template(db, template_id)
\ No newline at end of file
@@ -0,0 +1,359 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from . import coordination
+from .database import CONFIG_DIR
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow SMTP sessions
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Each worker process writes its values here so that a scrape, answered by
+# any one worker, reports the totals of all of them
+METRICS_DIR = os.path.join(CONFIG_DIR, "metrics")
+# Seconds between those writes; other workers' values in a scrape are at most this old
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+RETIRED = "retired"
+
+_registry = []
+_flush_task = None
+# Other processes' values, read once per scrape and used by every metric it renders
+_scrape = threading.local()
+
+class _Shards:
+    """
+    Per-thread value dicts. Writers only ever touch their own thread's dict,
+    so recording needs no lock; only scrapes, which merge all of them, take
+    one. Shards of threads that have exited are folded into `_retired` so
+    short-lived pools (one per broadcast) don't accumulate.
+    """
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._collect_lock = threading.Lock()
+
+    def local(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            self._shards.append((threading.current_thread(), values))
+            return values
+
+    def collect(self):
+        merged = {}
+        with self._collect_lock:
+            for shard in list(self._shards):
+                thread, values = shard
+                if thread.is_alive():
+                    self._merge(merged, values)
+                else:
+                    # An exited thread writes no more, so its values can move for good
+                    self._merge(self._retired, values)
+                    self._shards.remove(shard)
+            self._merge(merged, self._retired)
+        return merged
+
+def _merge_counts(target, values):
+    for key, value in list(values.items()):
+        target[key] = target.get(key, 0) + value
+
+def _merge_histograms(target, values):
+    for key, value in list(values.items()):
+        current = target.get(key)
+        target[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [*zip(labelnames, key), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = _Shards(_merge_counts)
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        values = self._shards.local()
+        key = _label_key(self.labelnames, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def values(self):
+        return _with_shared(self, self._shards.collect())
+
+    def value(self, **labels):
+        """The total across all worker processes."""
+        return self.values().get(_label_key(self.labelnames, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._shards = _Shards(_merge_histograms)
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        values = self._shards.local()
+        key = _label_key(self.labelnames, labels)
+        # Per-bucket (non-cumulative) counts, then +Inf, sum and count
+        state = values.get(key)
+        if state is None:
+            state = values[key] = [0] * (len(self.buckets) + 3)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def values(self):
+        return _with_shared(self, self._shards.collect())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, state in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Gauge:
+    """
+    A value read from `function` at scrape time; it returns {labels tuple: value}.
+    It runs in whichever worker answers the scrape, so derive it from counters
+    (whose value() is the total of all workers) rather than in-process state.
+    """
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.function().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+def render():
+    _scrape.shared = read_shared()
+    try:
+        lines = []
+        for metric in _registry:
+            lines.extend(metric.render())
+    finally:
+        _scrape.shared = None
+    return "\n".join(lines) + "\n"
+
+# Sharing between worker processes. Every process owns one file named after
+# its process id, rewritten every METRICS_FLUSH_INTERVAL seconds; a scrape
+# adds the files of the other processes to its own live values. Files of
+# processes that have exited are folded into one retired file, so counters
+# never go backwards when a worker restarts.
+
+def _path(name):
+    return os.path.join(METRICS_DIR, f"{name}.json")
+
+def _shared_metrics():
+    return {metric.name: metric for metric in _registry if not isinstance(metric, Gauge)}
+
+def _dump(values_by_name):
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in values_by_name.items()}
+
+def _load(path):
+    try:
+        with open(path) as metrics_file:
+            data = json.load(metrics_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {name: {tuple(key): value for key, value in items} for name, items in data.items()}
+
+def _write(name, values_by_name):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    temporary = f"{_path(name)}.{coordination.PROCESS_ID}"
+    with open(temporary, "w") as metrics_file:
+        json.dump(_dump(values_by_name), metrics_file)
+    os.replace(temporary, _path(name))
+
+def _merge_into(target, values_by_name):
+    metrics = _shared_metrics()
+    for name, values in values_by_name.items():
+        if name in metrics:
+            metrics[name]._shards._merge(target.setdefault(name, {}), values)
+
+def _with_shared(metric, values):
+    shared = getattr(_scrape, "shared", None)
+    if shared is None:
+        shared = read_shared()
+    other = shared.get(metric.name)
+    if other:
+        metric._shards._merge(values, other)
+    return values
+
+def flush():
+    """Write this process's values for the other workers to read."""
+    # Only registered processes can be told apart from exited ones, so an
+    # unregistered one (a script, a test client) keeps its values to itself
+    if coordination.is_registered():
+        _write(coordination.PROCESS_ID, {name: metric._shards.collect() for name, metric in _shared_metrics().items()})
+
+def _retire(process_id):
+    with coordination.file_lock("metrics"):
+        if not os.path.exists(_path(process_id)):
+            # Another worker retired it first
+            return
+        values = _load(_path(process_id))
+        retired = _load(_path(RETIRED))
+        _merge_into(retired, values)
+        _write(RETIRED, retired)
+        os.remove(_path(process_id))
+
+def read_shared():
+    """Values of every other process, live or exited, merged by metric name."""
+    try:
+        names = [filename[:-5] for filename in os.listdir(METRICS_DIR) if filename.endswith(".json")]
+    except FileNotFoundError:
+        return {}
+    names = [name for name in names if name != coordination.PROCESS_ID]
+    for name in names:
+        if name != RETIRED and not coordination.is_process_alive(name):
+            _retire(name)
+    merged = {}
+    for name in names:
+        if name == RETIRED or os.path.exists(_path(name)):
+            _merge_into(merged, _load(_path(name)))
+    return merged
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.to_thread(flush)
+        except Exception as e:
+            print(f"Writing metrics failed: {e}")
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+def start_flusher():
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_loop())
+
+async def stop_flusher():
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        await asyncio.gather(_flush_task, return_exceptions=True)
+        _flush_task = None
+    # Hand this process's final values over to the retired file before exiting
+    if coordination.is_registered():
+        await asyncio.to_thread(flush)
+        await asyncio.to_thread(_retire, coordination.PROCESS_ID)
+
+def hit_ratio(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+# HTTP
+http_request_duration = Histogram("notifyagent_http_request_duration_seconds", "Request latency by route.", ("method", "route", "status"))
+http_request_db_queries = Histogram(
+    "notifyagent_http_request_db_queries", "Database statements executed per request.", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+db_queries = Counter("notifyagent_db_queries_total", "Database statements executed.")
+
+# Delivery integrations
+smtp_duration = Histogram("notifyagent_smtp_seconds", "SMTP connect, login and send timings.", ("operation",))
+smtp_errors = Counter("notifyagent_smtp_errors_total", "Failed SMTP operations.", ("operation",))
+discord_webhook_duration = Histogram("notifyagent_discord_webhook_seconds", "Discord webhook post latency, including rate-limit waits.")
+discord_webhook_responses = Counter("notifyagent_discord_webhook_responses_total", "Discord webhook results by status code.", ("status",))
+tautulli_sync_duration = Histogram(
+    "notifyagent_tautulli_sync_seconds", "Tautulli user import duration.", ("trigger",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+)
+
+# Caches
+config_cache_lookups = Counter("notifyagent_config_cache_lookups_total", "Send configuration snapshot lookups.", ("result",))
+user_cache_lookups = Counter("notifyagent_user_cache_lookups_total", "Verified token cache lookups.", ("result",))
+
+# Statement count of the request being served; a one-item list so threadpool
+# copies of the context still add to the same total
+_request_queries = ContextVar("request_queries", default=None)
+
+def count_query(*args):
+    db_queries.inc()
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+def instrument_engine(db_engine):
+    from sqlalchemy import event
+    event.listen(db_engine, "before_cursor_execute", count_query)
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and statement count per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        queries = [0]
+        token = _request_queries.set(queries)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_queries.reset(token)
+            # The route template, not the raw path, keeps label cardinality bounded
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_request_duration.observe(time.perf_counter() - start, method=scope["method"], route=path, status=status_code)
+            http_request_db_queries.observe(queries[0], route=path)
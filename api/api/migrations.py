@@ -0,0 +1,82 @@
+from sqlalchemy import inspect, text
+from . import models
+
+# Stored in PRAGMA user_version once migrations have run. Bump it with every
+# change to the models or to the statements below, or it won't be applied
+SCHEMA_VERSION = 2
+
+# Full-text index over sent_messages. It is an external-content FTS5 table, so
+# the text lives only in sent_messages and the triggers keep the index in step
+SENT_MESSAGES_FTS = [
+    """CREATE VIRTUAL TABLE sent_messages_fts USING fts5(
+        subject, body, content='sent_messages', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER sent_messages_fts_ai AFTER INSERT ON sent_messages BEGIN
+        INSERT INTO sent_messages_fts(rowid, subject, body) VALUES (new.id, new.subject, new.body);
+    END""",
+    """CREATE TRIGGER sent_messages_fts_ad AFTER DELETE ON sent_messages BEGIN
+        INSERT INTO sent_messages_fts(sent_messages_fts, rowid, subject, body) VALUES ('delete', old.id, old.subject, old.body);
+    END""",
+    """CREATE TRIGGER sent_messages_fts_au AFTER UPDATE ON sent_messages BEGIN
+        INSERT INTO sent_messages_fts(sent_messages_fts, rowid, subject, body) VALUES ('delete', old.id, old.subject, old.body);
+        INSERT INTO sent_messages_fts(rowid, subject, body) VALUES (new.id, new.subject, new.body);
+    END""",
+    # Backfill messages sent before the index existed
+    "INSERT INTO sent_messages_fts(sent_messages_fts) VALUES ('rebuild')",
+]
+
+def create_sent_message_search(connection):
+    exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sent_messages_fts'")).first()
+    if exists:
+        return
+    for statement in SENT_MESSAGES_FTS:
+        connection.execute(text(statement))
+    print("Created full-text index for sent messages")
+
+def add_missing_columns(connection):
+    # create_all never alters existing tables, so add columns introduced since
+    inspector = inspect(connection)
+    for table in models.Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}"
+            if column.default is not None and column.default.is_scalar:
+                ddl += f" DEFAULT {int(column.default.arg) if isinstance(column.default.arg, bool) else repr(column.default.arg)}"
+            connection.execute(text(ddl))
+            print(f"Added column {table.name}.{column.name}")
+
+def backfill_delivery_job_due_at(connection):
+    # Jobs created before scheduled sends existed were due when they were queued
+    connection.execute(text("UPDATE delivery_jobs SET due_at = created_at WHERE due_at IS NULL"))
+
+# Indexes replaced by a better one since; dropped when migrating an older database
+DROPPED_INDEXES = ["ix_delivery_attempts_channel_created_at"]
+
+def drop_replaced_indexes(connection):
+    for name in DROPPED_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+def get_schema_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+def run_migrations(bind):
+    """Bring the schema up to date. Returns False when it already was, without touching it."""
+    with bind.connect() as connection:
+        if get_schema_version(connection) == SCHEMA_VERSION:
+            return False
+    models.Base.metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        add_missing_columns(connection)
+        backfill_delivery_job_due_at(connection)
+        drop_replaced_indexes(connection)
+    # create_all only builds indexes together with a new table, so add indexes
+    # introduced after a table was first created
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+    with bind.begin() as connection:
+        create_sent_message_search(connection)
+        connection.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+    return True
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, Float, Index, LargeBinary, text
 from datetime import datetime
-from .database import Base, engine
+from .database import Base
 from pydantic import BaseModel
+from typing import Literal, Optional
 
 class User(Base):
     __tablename__ = "users"
@@ -19,9 +20,17 @@ class Webhook(Base):
     webhook_url = Column(String)
     is_active = Column(Boolean, default=True)
     
+# Delivery lanes, most urgent first; stored on DeliveryJob.priority as the index
+PRIORITY_LANES = ("urgent", "normal", "low")
+
 class EmailRequest(BaseModel):
-    subject: str
-    body: str
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    # Sends a stored template instead; subject and body then default to the template's
+    template_id: Optional[int] = None
+    priority: Literal["urgent", "normal", "low"] = "normal"
+    # Deliver no earlier than this time (UTC when no timezone is given)
+    send_at: Optional[datetime] = None
 
 class WebhookRequest(BaseModel):
     channel_name: str
@@ -34,6 +43,8 @@ class TautulliRequest(BaseModel):
 class DiscordRequest(BaseModel):
     subject: str
     body: str
+    priority: Literal["urgent", "normal", "low"] = "normal"
+    send_at: Optional[datetime] = None
 
 class TautulliCredentials(Base):
     __tablename__ = "tautulli_credentials"
@@ -54,6 +65,9 @@ class Email(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True, nullable=False)
+    # Filled in from Tautulli, for personalized templates
+    username = Column(String, nullable=True)
+    friendly_name = Column(String, nullable=True)
     
 class ExclusionList(Base):
     __tablename__ = "exclusion_list"
@@ -77,7 +91,21 @@ class SentMessage(Base):
     body = Column(Text)
     services = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow)
+
+    # Keyset pagination walks the history by (timestamp, id)
+    __table_args__ = (Index("ix_sent_messages_timestamp_id", "timestamp", "id"),)
     
+class SentMessageArchive(Base):
+    __tablename__ = "sent_message_archive"
+
+    # One row per archived batch: gzip-compressed NDJSON of the messages it holds
+    id = Column(Integer, primary_key=True, index=True)
+    first_timestamp = Column(DateTime, index=True)
+    last_timestamp = Column(DateTime, index=True)
+    message_count = Column(Integer)
+    payload = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class MessageTemplate(Base):
     __tablename__ = "message_templates"
 
@@ -85,5 +113,60 @@ class MessageTemplate(Base):
     name = Column(String, unique=True, index=True)
     subject = Column(String)
     body = Column(Text)
+    # Bumped on every edit, so compiled copies of older versions are never reused
+    version = Column(Integer, default=1, nullable=False)
+
+class DeliveryJob(Base):
+    __tablename__ = "delivery_jobs"
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    id = Column(Integer, primary_key=True, index=True)
+    channel = Column(String, index=True)
+    subject = Column(String)
+    body = Column(Text)
+    template_id = Column(Integer, nullable=True)
+    template_version = Column(Integer, nullable=True)
+    status = Column(String, index=True, default="queued")
+    # Index into PRIORITY_LANES, lower is more urgent
+    priority = Column(Integer, default=1, nullable=False)
+    due_at = Column(DateTime, default=datetime.utcnow)
+    # coordination.PROCESS_ID of the process delivering a running job
+    claimed_by = Column(String, nullable=True)
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    # Partial index over queued jobs only, so finding due work never scans the job history
+    __table_args__ = (Index("ix_delivery_jobs_due_at_priority", "due_at", "priority", sqlite_where=text("status = 'queued'")),)
+
+class DeliveryAttempt(Base):
+    __tablename__ = "delivery_attempts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, index=True)
+    channel = Column(String)
+    # Recipient address for email, channel name for Discord
+    target = Column(String)
+    status = Column(String)
+    latency_ms = Column(Float)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Stats cover a recent time window, so the range column leads; the rest
+    # makes the stats query index-only. Rows are pruned by the retention job
+    __table_args__ = (Index("ix_delivery_attempts_created_at", "created_at", "channel", "status", "latency_ms"),)
+
+class TautulliSyncRun(Base):
+    __tablename__ = "tautulli_sync_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    trigger = Column(String)
+    started_at = Column(DateTime, default=datetime.utcnow, index=True)
+    duration_ms = Column(Float)
+    user_count = Column(Integer)
+    added = Column(Integer, default=0)
+    removed = Column(Integer, default=0)
+    users_hash = Column(String)
@@ -0,0 +1,119 @@
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+# Development aid, off by default: "header" adds X-DB-Profile to responses,
+# "log" prints one line per request, "1"/"all" does both
+SQL_PROFILE = os.getenv("SQL_PROFILE", "").lower()
+# A SELECT repeated this many times within one request is reported as a likely N+1
+SQL_PROFILE_N_PLUS_ONE = int(os.getenv("SQL_PROFILE_N_PLUS_ONE", "5"))
+
+PROFILE_HEADERS = SQL_PROFILE in ("1", "true", "yes", "all", "header")
+PROFILE_LOG = SQL_PROFILE in ("1", "true", "yes", "all", "log")
+ENABLED = PROFILE_HEADERS or PROFILE_LOG
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=1024)
+def fingerprint(statement):
+    """Normalize a statement so that executions differing only in values compare equal."""
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    # IN lists of any length collapse to one placeholder
+    return _IN_LIST.sub("(?)", statement)
+
+class QueryProfile:
+    def __init__(self, n_plus_one_threshold=SQL_PROFILE_N_PLUS_ONE):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.statements = 0
+        self.total_time = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, elapsed):
+        self.statements += 1
+        self.total_time += elapsed
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self):
+        return [(statement, count) for statement, count in self.fingerprints.most_common() if count > 1]
+
+    def n_plus_one(self):
+        return [
+            (statement, count) for statement, count in self.repeated()
+            if count >= self.n_plus_one_threshold and statement.upper().startswith("SELECT")
+        ]
+
+    def summary(self):
+        return f"statements={self.statements}; time_ms={self.total_time * 1000:.1f}; repeated={len(self.repeated())}; n_plus_one={len(self.n_plus_one())}"
+
+_current = ContextVar("query_profile", default=None)
+
+@contextmanager
+def profile(n_plus_one_threshold=SQL_PROFILE_N_PLUS_ONE):
+    """Collect the statements run inside the block, e.g. to assert query counts in a test."""
+    query_profile = QueryProfile(n_plus_one_threshold)
+    token = _current.set(query_profile)
+    try:
+        yield query_profile
+    finally:
+        _current.reset(token)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["profile_start"].pop()
+    query_profile = _current.get()
+    if query_profile is not None:
+        query_profile.record(statement, time.perf_counter() - start)
+
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get("profile_start") if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+def install(db_engine):
+    from sqlalchemy import event
+    if event.contains(db_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(db_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(db_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(db_engine, "handle_error", _handle_error)
+
+class ProfilerMiddleware:
+    """ASGI middleware that profiles each request's statements and reports them."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with profile() as query_profile:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start" and PROFILE_HEADERS:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-db-profile", query_profile.summary().encode("latin-1")))
+                    flagged = query_profile.n_plus_one()
+                    if flagged:
+                        statement, count = flagged[0]
+                        headers.append((b"x-db-profile-n-plus-one", f"{count}x {statement[:200]}".encode("latin-1", "replace")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+        if PROFILE_LOG:
+            print(f"SQL profile {scope['method']} {scope['path']}: {query_profile.summary()}")
+            for statement, count in query_profile.n_plus_one():
+                print(f"  likely N+1, {count}x: {statement}")
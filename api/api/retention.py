@@ -0,0 +1,143 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from . import coordination, models
+from .database import SessionLocal
+
+# Messages older than this many days move to the archive; 0 keeps everything hot
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_ARCHIVE_BATCH_SIZE = int(os.getenv("HISTORY_ARCHIVE_BATCH_SIZE", "1000"))
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv("HISTORY_ARCHIVE_INTERVAL", "24"))  # hours
+# Per-recipient delivery log rows older than this many days are deleted; 0 keeps them forever
+DELIVERY_LOG_RETENTION_DAYS = float(os.getenv("DELIVERY_LOG_RETENTION_DAYS", "30"))
+DELIVERY_LOG_PRUNE_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_PRUNE_BATCH_SIZE", "10000"))
+
+_archive_task = None
+# Only one worker process runs the scheduled archive
+_leader = coordination.LeaderLock("history-archive")
+
+def _to_record(message):
+    return {
+        "id": message.id,
+        "subject": message.subject,
+        "body": message.body,
+        "services": message.services,
+        "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+    }
+
+def archive_sent_messages(db, older_than_days, batch_size=HISTORY_ARCHIVE_BATCH_SIZE):
+    """
+    Move messages older than `older_than_days` into sent_message_archive,
+    one compressed batch per transaction so the hot table is never locked
+    for long. Returns the number of messages archived.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    while True:
+        messages = (
+            db.query(models.SentMessage)
+            .filter(models.SentMessage.timestamp < cutoff)
+            .order_by(models.SentMessage.timestamp, models.SentMessage.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not messages:
+            return archived
+
+        lines = b"".join(json.dumps(_to_record(message)).encode() + b"\n" for message in messages)
+        db.add(models.SentMessageArchive(
+            first_timestamp=messages[0].timestamp,
+            last_timestamp=messages[-1].timestamp,
+            message_count=len(messages),
+            payload=gzip.compress(lines),
+        ))
+        db.query(models.SentMessage).filter(
+            models.SentMessage.id.in_([message.id for message in messages])
+        ).delete(synchronize_session=False)
+        db.commit()
+        archived += len(messages)
+
+def prune_delivery_attempts(db, older_than_days, batch_size=DELIVERY_LOG_PRUNE_BATCH_SIZE):
+    """
+    Delete delivery_attempts rows older than `older_than_days`, a batch per
+    transaction. The log gets a row per recipient per broadcast, so without
+    this it grows with all history. Returns the number of rows deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    deleted = 0
+    while True:
+        ids = [
+            row.id for row in db.query(models.DeliveryAttempt.id)
+            .filter(models.DeliveryAttempt.created_at < cutoff)
+            .limit(batch_size)
+        ]
+        if not ids:
+            return deleted
+        db.query(models.DeliveryAttempt).filter(models.DeliveryAttempt.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+
+def iter_archived_messages(since=None, until=None):
+    """Yield archived messages as NDJSON lines, decompressing one batch at a time."""
+    # Archived timestamps are naive UTC
+    since, until = (
+        bound.astimezone(timezone.utc).replace(tzinfo=None) if bound is not None and bound.tzinfo is not None else bound
+        for bound in (since, until)
+    )
+    db = SessionLocal()
+    try:
+        query = db.query(models.SentMessageArchive.id).order_by(models.SentMessageArchive.first_timestamp, models.SentMessageArchive.id)
+        if since is not None:
+            query = query.filter(models.SentMessageArchive.last_timestamp >= since)
+        if until is not None:
+            query = query.filter(models.SentMessageArchive.first_timestamp < until)
+        batch_ids = [row.id for row in query]
+
+        for batch_id in batch_ids:
+            payload = db.query(models.SentMessageArchive.payload).filter(models.SentMessageArchive.id == batch_id).scalar()
+            for line in gzip.decompress(payload).splitlines(keepends=True):
+                if since is not None or until is not None:
+                    timestamp = datetime.fromisoformat(json.loads(line)["timestamp"])
+                    if (since is not None and timestamp < since) or (until is not None and timestamp >= until):
+                        continue
+                yield line
+    finally:
+        db.close()
+
+def _run_scheduled_archive():
+    db = SessionLocal()
+    try:
+        if HISTORY_RETENTION_DAYS > 0:
+            archived = archive_sent_messages(db, HISTORY_RETENTION_DAYS)
+            if archived:
+                print(f"Archived {archived} sent message(s) older than {HISTORY_RETENTION_DAYS:g} days")
+        if DELIVERY_LOG_RETENTION_DAYS > 0:
+            pruned = prune_delivery_attempts(db, DELIVERY_LOG_RETENTION_DAYS)
+            if pruned:
+                print(f"Deleted {pruned} delivery log row(s) older than {DELIVERY_LOG_RETENTION_DAYS:g} days")
+    finally:
+        db.close()
+
+async def _archive_loop():
+    while True:
+        try:
+            if _leader.acquire():
+                await asyncio.to_thread(_run_scheduled_archive)
+        except Exception as e:
+            print(f"Scheduled history archive failed: {e}")
+        await asyncio.sleep(HISTORY_ARCHIVE_INTERVAL * 3600)
+
+def start_archive_scheduler():
+    global _archive_task
+    if (HISTORY_RETENTION_DAYS > 0 or DELIVERY_LOG_RETENTION_DAYS > 0) and _archive_task is None:
+        _archive_task = asyncio.create_task(_archive_loop())
+
+async def stop_archive_scheduler():
+    global _archive_task
+    if _archive_task is not None:
+        _archive_task.cancel()
+        await asyncio.gather(_archive_task, return_exceptions=True)
+        _archive_task = None
+    _leader.release()
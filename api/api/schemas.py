@@ -138,6 +138,32 @@ class SentMessage(SentMessageBase):
     class Config:
         from_attributes: True
 
+class SentMessageSummary(BaseModel):
+    id: int
+    subject: str
+    services: str
+    timestamp: datetime
+    body_preview: str
+    body_truncated: bool
+
+class SentMessagePage(BaseModel):
+    items: List[SentMessageSummary]
+    next_cursor: Optional[str] = None
+
+class SentMessageSearchResult(BaseModel):
+    id: int
+    subject: str
+    services: str
+    timestamp: datetime
+    # HTML-escaped message text with matches wrapped in <mark>
+    subject_highlight: str
+    body_snippet: str
+    rank: float
+
+class SentMessageSearchPage(BaseModel):
+    items: List[SentMessageSearchResult]
+    next_offset: Optional[int] = None
+
 class MessageTemplateBase(BaseModel):
     name: str
     subject: str
@@ -148,6 +174,50 @@ class MessageTemplateCreate(MessageTemplateBase):
 
 class MessageTemplate(MessageTemplateBase):
     id: int
+    version: int
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class DeliveryJob(BaseModel):
+    id: int
+    channel: str
+    status: str
+    priority: int
+    due_at: Optional[datetime] = None
+    total: int
+    sent: int
+    failed: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class DeliveryChannelStats(BaseModel):
+    channel: str
+    attempts: int
+    sent: int
+    failed: int
+    success_rate: float
+    p50_latency_ms: Optional[float] = None
+    p95_latency_ms: Optional[float] = None
+
+class TautulliSyncRun(BaseModel):
+    trigger: str
+    started_at: datetime
+    duration_ms: float
+    user_count: int
+    added: int
+    removed: int
+    changed: bool = True
+
+    class Config:
+        from_attributes = True
+
+class TautulliSyncStatus(BaseModel):
+    interval_minutes: float
+    last_check: Optional[TautulliSyncRun] = None
+    recent_runs: List[TautulliSyncRun]
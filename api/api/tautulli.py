@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import os
+import time
+from datetime import datetime
+from . import coordination, crud, metrics
+from .database import SessionLocal
+
+TAUTULLI_TIMEOUT = float(os.getenv("TAUTULLI_TIMEOUT", "30"))
+# 0 streams a single get_users response; a positive value pages through get_users_table
+TAUTULLI_PAGE_SIZE = int(os.getenv("TAUTULLI_PAGE_SIZE", "0"))
+# Minutes between background syncs of the recipient list, 0 disables them
+TAUTULLI_SYNC_INTERVAL = float(os.getenv("TAUTULLI_SYNC_INTERVAL", "0"))
+
+class TautulliError(Exception):
+    pass
+
+def _request(base_url, api_key, cmd, **params):
+    # requests and ijson are only loaded once a sync actually runs
+    import requests
+    url = f"{base_url.rstrip('/')}/api/v2"
+    try:
+        response = requests.get(url, params={"apikey": api_key, "cmd": cmd, **params}, stream=True, timeout=TAUTULLI_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise TautulliError(f"Tautulli request failed: {e}")
+    # Let urllib3 undo any gzip transfer encoding while ijson reads the raw stream
+    response.raw.decode_content = True
+    return response
+
+def _stream_rows(response, rows_prefix, fields):
+    """
+    Incrementally parse the rows under `rows_prefix` and yield a dict of just
+    `fields` for each one; the full payload is never held in memory.
+    """
+    import ijson
+    import requests
+    import urllib3
+    result = None
+    row = None
+    field_prefixes = {f"{rows_prefix}.{field}": field for field in fields}
+    try:
+        for prefix, event, value in ijson.parse(response.raw):
+            if prefix == "response.result":
+                result = value
+                if result != "success":
+                    break
+            elif prefix == rows_prefix:
+                if event == "start_map":
+                    row = {}
+                elif event == "end_map":
+                    yield row
+                    row = None
+            elif row is not None and prefix in field_prefixes and event != "null":
+                row[field_prefixes[prefix]] = value
+    except ijson.JSONError as e:
+        raise TautulliError(f"Invalid response from Tautulli: {e}")
+    except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+        # The connection can drop after the headers, while the rows are being read
+        raise TautulliError(f"Tautulli response was interrupted: {e}")
+    finally:
+        response.close()
+    if result != "success":
+        raise TautulliError("Failed to retrieve users from Tautulli")
+
+def iter_users(base_url, api_key, fields=("email",), page_size=TAUTULLI_PAGE_SIZE):
+    """Yield one dict per Tautulli user holding only the requested fields."""
+    if page_size <= 0:
+        response = _request(base_url, api_key, "get_users")
+        yield from _stream_rows(response, "response.data.item", fields)
+        return
+
+    start = 0
+    while True:
+        response = _request(base_url, api_key, "get_users_table", start=start, length=page_size)
+        count = 0
+        for row in _stream_rows(response, "response.data.data.item", fields):
+            count += 1
+            yield row
+        if count < page_size:
+            return
+        start += page_size
+
+_sync_task = None
+# Only one worker process runs the scheduled sync
+_leader = coordination.LeaderLock("tautulli-sync")
+
+def iter_user_profiles(base_url, api_key, page_size=TAUTULLI_PAGE_SIZE):
+    """Yield (email, username, friendly_name) for every user with an email address."""
+    for user in iter_users(base_url, api_key, ("email", "username", "friendly_name"), page_size):
+        if user.get("email"):
+            yield user["email"], user.get("username"), user.get("friendly_name")
+
+def _users_hash(profiles, exclusions):
+    digest = hashlib.sha256()
+    for email in sorted(profiles):
+        username, friendly_name = profiles[email]
+        # Names feed personalized templates, so a rename is a change too
+        digest.update(f"{email}\t{username or ''}\t{friendly_name or ''}\n".encode())
+    # Exclusions decide which users become recipients, so they are part of the fingerprint
+    digest.update(b"--exclusions--\n")
+    for email in exclusions:
+        digest.update(email.encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def sync_users(db, trigger="scheduled", force=False):
+    """
+    Pull the Tautulli user list and apply it to the recipient table. Unless
+    `force` is set, the write phase is skipped when neither the user list nor
+    the exclusion list changed since the last recorded sync. Returns a
+    schemas.TautulliSyncRun-shaped dict, or None without credentials.
+    """
+    credentials = crud.get_tautulli_credentials(db)
+    if not credentials:
+        return None
+
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    profiles = {email: (username, friendly_name) for email, username, friendly_name in iter_user_profiles(credentials.base_url, credentials.api_key)}
+    emails = sorted(profiles)
+    exclusions = sorted(row.email for row in crud.get_exclusion_emails(db))
+    users_hash = _users_hash(profiles, exclusions)
+
+    last_runs = crud.get_tautulli_sync_runs(db, limit=1)
+    run = {"trigger": trigger, "started_at": started_at, "user_count": len(emails), "added": 0, "removed": 0, "changed": False}
+    if force or not last_runs or last_runs[0].users_hash != users_hash:
+        run["added"], run["removed"] = crud.sync_emails(db, emails, profiles)
+        run["changed"] = True
+    run["duration_ms"] = (time.perf_counter() - start) * 1000
+    metrics.tautulli_sync_duration.observe(run["duration_ms"] / 1000, trigger=trigger)
+
+    if run["changed"]:
+        crud.create_tautulli_sync_run(db, users_hash=users_hash, **{key: value for key, value in run.items() if key != "changed"})
+    # Shared through a file, since the scheduled sync runs in only one worker
+    coordination.write_state("tautulli-last-check", run)
+    return run
+
+def get_last_check():
+    return coordination.read_state("tautulli-last-check")
+
+def _run_scheduled_sync():
+    db = SessionLocal()
+    try:
+        run = sync_users(db)
+        if run and run["changed"]:
+            print(f"Tautulli sync: {run['added']} emails added, {run['removed']} removed in {run['duration_ms']:.0f} ms")
+    finally:
+        db.close()
+
+async def _sync_loop():
+    while True:
+        try:
+            if _leader.acquire():
+                await asyncio.to_thread(_run_scheduled_sync)
+        except Exception as e:
+            print(f"Scheduled Tautulli sync failed: {e}")
+        await asyncio.sleep(TAUTULLI_SYNC_INTERVAL * 60)
+
+def start_sync_scheduler():
+    global _sync_task
+    if TAUTULLI_SYNC_INTERVAL > 0 and _sync_task is None:
+        _sync_task = asyncio.create_task(_sync_loop())
+
+async def stop_sync_scheduler():
+    global _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        await asyncio.gather(_sync_task, return_exceptions=True)
+        _sync_task = None
+    _leader.release()
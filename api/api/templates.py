@@ -0,0 +1,106 @@
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Value of the {{ server_name }} placeholder
+SERVER_NAME = os.getenv("SERVER_NAME", "Plex")
+# Compiled templates kept in memory, keyed by (template_id, version)
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "128"))
+
+VARIABLES = ("username", "friendly_name", "email", "server_name")
+PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+class TemplateError(Exception):
+    pass
+
+def _compile_text(source, strict=True):
+    """
+    Turn `{{ name }}` placeholders into a str.format string, so rendering is a
+    single C-level format_map call. Returns (format_string, variable_names).
+    Unknown placeholders raise TemplateError, or stay literal text unless `strict`.
+    """
+    parts = []
+    names = set()
+    position = 0
+    for match in PLACEHOLDER.finditer(source):
+        name = match.group(1)
+        if name not in VARIABLES:
+            if not strict:
+                # Left in place: it becomes part of the next literal segment
+                continue
+            raise TemplateError(f"Unknown template variable '{name}', expected one of: {', '.join(VARIABLES)}")
+        parts.append(source[position:match.start()].replace("{", "{{").replace("}", "}}"))
+        parts.append("{" + name + "}")
+        names.add(name)
+        position = match.end()
+    parts.append(source[position:].replace("{", "{{").replace("}", "}}"))
+    return "".join(parts), frozenset(names)
+
+class CompiledTemplate:
+    def __init__(self, subject, body, strict=True):
+        self._subject, subject_names = _compile_text(subject, strict)
+        self._body, body_names = _compile_text(body, strict)
+        self.variables = subject_names | body_names
+        # Texts without placeholders are returned as-is instead of formatted
+        self._static_subject = subject if not subject_names else None
+        self._static_body = body if not body_names else None
+
+    @property
+    def is_personalized(self):
+        return bool(self.variables - {"server_name"})
+
+    def render(self, values):
+        """Render (subject, body); `values` must hold every variable in self.variables."""
+        subject = self._static_subject if self._static_subject is not None else self._subject.format_map(values)
+        if self._static_body is not None:
+            return subject, self._static_body
+        # The body is sent as HTML, so recipient data is escaped there
+        escaped = {name: html.escape(values[name]) for name in self.variables}
+        return subject, self._body.format_map(escaped)
+
+    def render_batch(self, recipients):
+        """Render for a batch of recipient rows with email, username and friendly_name."""
+        return [self.render(recipient_values(recipient)) for recipient in recipients]
+
+def recipient_values(recipient):
+    username = recipient.username or recipient.email.split("@")[0]
+    return {
+        "username": username,
+        "friendly_name": recipient.friendly_name or username,
+        "email": recipient.email,
+        "server_name": SERVER_NAME,
+    }
+
+def render_shared(text):
+    """
+    Fill in the variables that are the same for every recipient, leaving any
+    other placeholder as written; for channels without per-recipient
+    messages, like Discord.
+    """
+    return PLACEHOLDER.sub(lambda match: SERVER_NAME if match.group(1) == "server_name" else match.group(0), text)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def compile_template(subject, body, template_id=None, version=None, strict=None):
+    """
+    Compile a template, reusing the cached result for (template_id, version).
+    Ad-hoc texts without a template id are compiled without caching and, by
+    default, leniently: free text may contain `{{ word }}` that isn't a variable.
+    """
+    if template_id is None:
+        return CompiledTemplate(subject, body, strict=bool(strict))
+    key = (template_id, version)
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            return compiled
+    compiled = CompiledTemplate(subject, body)
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > TEMPLATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
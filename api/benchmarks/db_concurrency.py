@@ -0,0 +1,101 @@
+"""
+Parallel read/write load against the SQLite engine, comparing the tuned
+pragmas from database.py with SQLite's defaults.
+
+    python -m api.benchmarks.db_concurrency --threads 16 --seconds 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Keep the benchmark away from the real database
+os.environ.setdefault("CONFIG_DIR", tempfile.mkdtemp(prefix="notifyagent-bench-"))
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from api.api import models
+from api.api.database import create_db_engine, SQLITE_PRAGMAS
+
+DEFAULT_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 0}
+
+def run(pragmas, threads, seconds, write_ratio):
+    path = os.path.join(tempfile.mkdtemp(prefix="notifyagent-bench-"), "bench.db")
+    engine = create_db_engine(f"sqlite:///{path}", pragmas=pragmas, pool_size=threads, max_overflow=0)
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    with Session() as db:
+        db.add_all(models.Email(email=f"user{i}@example.com") for i in range(5000))
+        db.commit()
+
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(index):
+        local = {"reads": 0, "writes": 0, "locked": 0}
+        local_latencies = []
+        step = 0
+        with Session() as db:
+            while time.perf_counter() < deadline:
+                step += 1
+                start = time.perf_counter()
+                try:
+                    if (step * (index + 1)) % 100 < write_ratio * 100:
+                        db.add(models.SentMessage(subject=f"bench {index}-{step}", body="x" * 500, services="email(1)"))
+                        db.commit()
+                        local["writes"] += 1
+                    else:
+                        db.query(models.Email.email).order_by(models.Email.email).limit(100).all()
+                        db.query(models.SentMessage.id).order_by(models.SentMessage.id.desc()).limit(20).all()
+                        db.commit()
+                        local["reads"] += 1
+                except OperationalError:
+                    db.rollback()
+                    local["locked"] += 1
+                local_latencies.append(time.perf_counter() - start)
+        with lock:
+            for key, value in local.items():
+                counts[key] += value
+            latencies.extend(local_latencies)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    engine.dispose()
+
+    latencies.sort()
+    total = counts["reads"] + counts["writes"]
+    return {
+        **counts,
+        "ops_per_sec": round(total / seconds, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3) if latencies else None,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = {
+        "threads": args.threads,
+        "write_ratio": args.write_ratio,
+        "default": run(DEFAULT_PRAGMAS, args.threads, args.seconds, args.write_ratio),
+        "tuned": run(SQLITE_PRAGMAS, args.threads, args.seconds, args.write_ratio),
+    }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return results
+
+if __name__ == "__main__":
+    main()
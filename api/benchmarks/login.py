@@ -0,0 +1,83 @@
+"""
+Login throughput and latency under a burst of concurrent logins, plus the
+latency of a cheap request issued during the burst (event loop health).
+
+    python -m api.benchmarks.login --concurrency 20 --logins 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("CONFIG_DIR", tempfile.mkdtemp(prefix="notifyagent-bench-"))
+# The benchmark hammers a single account; keep the throttle out of the measurement
+os.environ.setdefault("LOGIN_MAX_ATTEMPTS_PER_USER", "1000000")
+os.environ.setdefault("LOGIN_MAX_ATTEMPTS_PER_IP", "1000000")
+os.environ.setdefault("ADMIN_USERNAME", "bench")
+os.environ.setdefault("ADMIN_PASSWORD", "bench-password")
+
+import httpx
+from api.api import main as api_main
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2) if values else None
+
+async def run(concurrency, logins):
+    # ASGITransport doesn't send lifespan events, so run startup and shutdown ourselves
+    transport = httpx.ASGITransport(app=api_main.app)
+    async with api_main.lifespan(api_main.app), httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        semaphore = asyncio.Semaphore(concurrency)
+        login_latencies = []
+        probe_latencies = []
+        statuses = {}
+        done = asyncio.Event()
+
+        async def login():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/login/", data={"username": os.environ["ADMIN_USERNAME"], "password": os.environ["ADMIN_PASSWORD"]})
+                login_latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/discord_rate_limits/")
+                probe_latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    return {
+        "concurrency": concurrency,
+        "logins": logins,
+        "statuses": statuses,
+        "logins_per_sec": round(logins / elapsed, 2),
+        "login_p50_ms": percentile(login_latencies, 0.5),
+        "login_p99_ms": percentile(login_latencies, 0.99),
+        "probe_p50_ms": percentile(probe_latencies, 0.5),
+        "probe_p99_ms": percentile(probe_latencies, 0.99),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.concurrency, args.logins))
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Local stand-ins for the services NotifyAgent talks to, for benchmarks: an
+SMTP sink, a Discord webhook server (optionally rate limiting) and a
+Tautulli API serving a generated user list.
+"""
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class _Server:
+    """Runs a ThreadingHTTPServer with `handler` on a free local port."""
+
+    def __init__(self, handler):
+        self.port = free_port()
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+        self._server.daemon_threads = True
+        # Handlers reach their stand-in through the server
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class SMTPSink:
+    """Accepts every message and counts envelopes and recipients."""
+
+    def __init__(self):
+        # aiosmtpd is only needed to run the benchmarks (api/benchmarks/requirements.txt), not the app
+        from aiosmtpd.controller import Controller
+
+        sink = self
+
+        class Handler:
+            async def handle_DATA(self, server, session, envelope):
+                with sink._lock:
+                    sink.messages += 1
+                    sink.recipients += len(envelope.rcpt_tos)
+                return "250 OK"
+
+        self.messages = 0
+        self.recipients = 0
+        self._lock = threading.Lock()
+        self.port = free_port()
+        self._controller = Controller(Handler(), hostname="127.0.0.1", port=self.port)
+
+    def start(self):
+        self._controller.start()
+        return self
+
+    def stop(self):
+        self._controller.stop()
+
+class _DiscordHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        stand_in = self.server.stand_in
+        retry_after = stand_in.take(self.path)
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        if retry_after is not None:
+            body = json.dumps({"message": "You are being rate limited.", "retry_after": retry_after, "global": stand_in.global_limit}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            if stand_in.global_limit:
+                self.send_header("X-RateLimit-Global", "true")
+            self.send_header("Retry-After", str(retry_after))
+            self.send_header("X-RateLimit-Remaining", "0")
+            self.send_header("X-RateLimit-Reset-After", str(retry_after))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class MockDiscord(_Server):
+    """
+    Answers webhook posts with 204. With `rate_limit`, each webhook accepts
+    that many posts per `window` seconds and answers 429 with Retry-After
+    beyond it, like Discord's per-webhook buckets; with `global_limit` the
+    429s are flagged as global.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=None, window=1.0, global_limit=False):
+        super().__init__(_DiscordHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.global_limit = global_limit
+        self.requests = 0
+        self.rate_limited = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def webhook_url(self, index):
+        return f"{self.url}/api/webhooks/{index}/token"
+
+    def take(self, path):
+        """Count a post; returns Retry-After seconds when it should be rejected."""
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return None
+            now = time.monotonic()
+            window_start, count = self._buckets.get(path, (now, 0))
+            if now - window_start >= self.window:
+                window_start, count = now, 0
+            if count >= self.rate_limit:
+                self.rate_limited += 1
+                return round(self.window - (now - window_start), 3)
+            self._buckets[path] = (window_start, count + 1)
+            return None
+
+class _TautulliHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        if params.get("cmd") == "get_users_table":
+            start = int(params.get("start", 0))
+            users = range(start, min(start + int(params.get("length", 25)), stand_in.user_count))
+            prefix, suffix = b'{"response": {"result": "success", "message": null, "data": {"data": [', b"]}}}"
+        else:
+            users = range(stand_in.user_count)
+            prefix, suffix = b'{"response": {"result": "success", "message": null, "data": [', b"]}}"
+
+        # Streamed in chunks, so 100k users never sit in memory as one document
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._write_chunk(prefix)
+        batch = []
+        for index in users:
+            batch.append(json.dumps(stand_in.user(index)))
+            if len(batch) == 1000:
+                self._write_chunk((",".join(batch) + ("," if index + 1 < users.stop else "")).encode())
+                batch = []
+        if batch:
+            self._write_chunk(",".join(batch).encode())
+        self._write_chunk(suffix)
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+class FakeTautulli(_Server):
+    """Serves get_users and get_users_table for `user_count` generated users."""
+
+    def __init__(self, user_count=1000):
+        super().__init__(_TautulliHandler)
+        self.user_count = user_count
+
+    @staticmethod
+    def user(index):
+        return {
+            "user_id": index,
+            "username": f"user{index}",
+            "friendly_name": f"User {index}",
+            "email": f"user{index:06d}@example.com",
+            "is_active": 1,
+        }
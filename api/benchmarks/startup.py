@@ -0,0 +1,117 @@
+"""
+Cold start cost of the API process: import time of api.api.main, measured
+with `python -X importtime`, and the time from spawning uvicorn to the first
+200 response, for a fresh database and for one whose schema is current.
+
+    python -m api.benchmarks.startup --runs 3 --max-import-ms 1500 --max-first-200-ms 4000
+
+Exits non-zero when a threshold is exceeded or a heavy integration is
+imported at startup, so it can guard against regressions.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Integrations that must only load on first use
+LAZY_MODULES = ("smtplib", "email.mime", "httpx", "requests", "ijson", "jose", "passlib", "bcrypt")
+PROBE_PATH = "/tautulli_sync_status/"
+
+def _env(config_dir):
+    return {**os.environ, "CONFIG_DIR": config_dir, "TAUTULLI_SYNC_INTERVAL": "0", "PYTHONPATH": ROOT}
+
+def import_time(config_dir):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.api.main"],
+        cwd=ROOT, env=_env(config_dir), capture_output=True, text=True, check=True,
+    )
+    total_us = None
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        loaded.add(name)
+        if name == "api.api.main":
+            total_us = int(cumulative)
+    eager = sorted(module for module in LAZY_MODULES if module in loaded)
+    return total_us / 1000, eager
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def first_200(config_dir, timeout=60):
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.api.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=_env(config_dir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{PROBE_PATH}", timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - start) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+            time.sleep(0.01)
+        raise RuntimeError(f"No 200 from {PROBE_PATH} within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    parser.add_argument("--max-first-200-ms", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    imports, cold, warm = [], [], []
+    eager = []
+    for _ in range(args.runs):
+        config_dir = tempfile.mkdtemp(prefix="notifyagent-bench-")
+        import_ms, eager = import_time(config_dir)
+        imports.append(import_ms)
+        # The first start migrates and seeds the new database, the second finds it current
+        cold.append(first_200(config_dir))
+        warm.append(first_200(config_dir))
+
+    results = {
+        "runs": args.runs,
+        "import_ms": round(statistics.median(imports), 1),
+        "first_200_cold_ms": round(statistics.median(cold), 1),
+        "first_200_warm_ms": round(statistics.median(warm), 1),
+        "eager_heavy_modules": eager,
+    }
+    regressions = []
+    if eager:
+        regressions.append(f"imported at startup: {', '.join(eager)}")
+    if args.max_import_ms is not None and results["import_ms"] > args.max_import_ms:
+        regressions.append(f"import took {results['import_ms']} ms (limit {args.max_import_ms})")
+    if args.max_first_200_ms is not None and results["first_200_warm_ms"] > args.max_first_200_ms:
+        regressions.append(f"first 200 after {results['first_200_warm_ms']} ms (limit {args.max_first_200_ms})")
+    results["regressions"] = regressions
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if regressions:
+        sys.exit(1)
+    return results
+
+if __name__ == "__main__":
+    main()
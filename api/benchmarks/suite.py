@@ -0,0 +1,249 @@
+"""
+End-to-end benchmarks of the send, import and history paths, run against
+local stand-ins for SMTP, Discord and Tautulli. Results are written as JSON
+so runs can be compared between commits. The SMTP stand-in needs aiosmtpd,
+which the app itself doesn't:
+
+    pip install -r api/benchmarks/requirements.txt
+    python -m api.benchmarks.suite --output bench.json
+    python -m api.benchmarks.suite --scenarios import --import-sizes 1000,10000,100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from api.benchmarks.stand_ins import FakeTautulli, MockDiscord, SMTPSink
+
+SCENARIOS = ("email", "discord", "import", "history")
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 2) if values else None
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def wait_for_job(client, job_id, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        job = (await client.get(f"/delivery_jobs/{job_id}")).json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        await asyncio.sleep(0.02)
+    raise TimeoutError(f"Delivery job {job_id} did not finish within {timeout}s")
+
+def job_seconds(job):
+    return (datetime.fromisoformat(job["finished_at"]) - datetime.fromisoformat(job["started_at"])).total_seconds()
+
+async def bench_email(client, app, sink, recipients):
+    db = app.SessionLocal()
+    try:
+        app.crud.sync_emails(db, [f"recipient{index:07d}@example.com" for index in range(recipients)])
+    finally:
+        db.close()
+    await client.post("/set_email_credentials/", json={"email_address": "bench@example.com", "email_password": "unused"})
+
+    results = {}
+    for name, body in (("broadcast", "Benchmark body\nwith two lines"), ("personalized", "Hello {{ friendly_name }}\non {{ server_name }}")):
+        sink.messages = sink.recipients = 0
+        start = time.perf_counter()
+        response = (await client.post("/send_email/", json={"subject": "Benchmark", "body": body})).json()
+        job = await wait_for_job(client, response["job_id"])
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "recipients": recipients,
+            "status": job["status"],
+            "sent": job["sent"],
+            "smtp_messages": sink.messages,
+            "seconds": round(elapsed, 3),
+            "recipients_per_sec": round(job["sent"] / job_seconds(job), 1),
+        }
+    return results
+
+async def bench_discord(client, app, webhooks, latency):
+    results = {}
+    for name, rate_limit in (("ok", None), ("rate_limited", 2)):
+        discord = MockDiscord(latency=latency, rate_limit=rate_limit).start()
+        try:
+            db = app.SessionLocal()
+            try:
+                db.query(app.models.Webhook).delete()
+                db.commit()
+                app.config_cache.invalidate()
+            finally:
+                db.close()
+            for index in range(webhooks):
+                await client.post("/set_webhook/", json={"channel_name": f"bench-{index}", "webhook_url": discord.webhook_url(index)})
+
+            # Three broadcasts in a row: with a limit of 2 per window, the third hits 429s
+            jobs = []
+            start = time.perf_counter()
+            for _ in range(3):
+                response = (await client.post("/send_discord/", json={"subject": "Benchmark", "body": "Fan-out"})).json()
+                jobs.append(await wait_for_job(client, response["job_id"]))
+            elapsed = time.perf_counter() - start
+
+            db = app.SessionLocal()
+            try:
+                latencies = [row.latency_ms for row in db.query(app.models.DeliveryAttempt.latency_ms).filter(
+                    app.models.DeliveryAttempt.job_id.in_([job["id"] for job in jobs])
+                )]
+            finally:
+                db.close()
+            results[name] = {
+                "webhooks": webhooks,
+                "broadcasts": len(jobs),
+                "sent": sum(job["sent"] for job in jobs),
+                "failed": sum(job["failed"] for job in jobs),
+                "seconds": round(elapsed, 3),
+                "fan_out_ms": [round(job_seconds(job) * 1000, 1) for job in jobs],
+                "webhook_p50_ms": percentile(latencies, 0.5),
+                "webhook_p95_ms": percentile(latencies, 0.95),
+                "server_requests": discord.requests,
+                "server_429s": discord.rate_limited,
+            }
+        finally:
+            discord.stop()
+    return results
+
+async def bench_import(client, app, sizes):
+    tautulli = FakeTautulli().start()
+    results = {}
+    try:
+        await client.post("/set_tautulli_credentials/", json={"api_key": "bench", "base_url": tautulli.url})
+        for size in sizes:
+            db = app.SessionLocal()
+            try:
+                db.query(app.models.Email).delete()
+                db.commit()
+            finally:
+                db.close()
+            tautulli.user_count = size
+            start = time.perf_counter()
+            response = await client.post("/import_emails/")
+            elapsed = time.perf_counter() - start
+            results[str(size)] = {
+                "status_code": response.status_code,
+                "emails": len(response.json().get("emails", [])),
+                "seconds": round(elapsed, 3),
+                "users_per_sec": round(size / elapsed, 1),
+            }
+    finally:
+        tautulli.stop()
+    return results
+
+async def timed_get(client, path, repeats, **params):
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        response = await client.get(path, params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+    return {"p50_ms": percentile(latencies, 0.5), "p95_ms": percentile(latencies, 0.95)}
+
+async def bench_history(client, app, size, repeats):
+    from sqlalchemy import insert
+
+    db = app.SessionLocal()
+    try:
+        db.query(app.models.SentMessage).delete()
+        start = datetime.utcnow() - timedelta(minutes=size)
+        rows = [
+            {"subject": f"Announcement {index}", "body": f"Message body {index} " * 20, "services": "email,discord", "timestamp": start + timedelta(minutes=index)}
+            for index in range(size)
+        ]
+        for offset in range(0, size, 10000):
+            db.execute(insert(app.models.SentMessage), rows[offset:offset + 10000])
+        db.commit()
+    finally:
+        db.close()
+
+    # Walk the keyset pages to find a cursor deep into the history
+    cursor = None
+    for _ in range(min(20, max(size // 100 - 1, 0))):
+        page = (await client.get("/sent_messages/", params={"limit": 100, **({"cursor": cursor} if cursor else {})})).json()
+        cursor = page["next_cursor"] or cursor
+
+    return {
+        "messages": size,
+        "get_sent_messages_first_page": await timed_get(client, "/get_sent_messages/", repeats, skip=0, limit=100),
+        "get_sent_messages_last_page": await timed_get(client, "/get_sent_messages/", repeats, skip=max(size - 100, 0), limit=100),
+        "sent_messages_first_page": await timed_get(client, "/sent_messages/", repeats, limit=100),
+        "sent_messages_deep_page": await timed_get(client, "/sent_messages/", repeats, limit=100, **({"cursor": cursor} if cursor else {})),
+        "search": await timed_get(client, "/search_sent_messages/", repeats, q="announcement", limit=20),
+    }
+
+async def run(args, sink):
+    import httpx
+    from api.api import main, crud, models, config_cache
+    from api.api.database import SessionLocal
+
+    app = SimpleNamespace(crud=crud, models=models, config_cache=config_cache, SessionLocal=SessionLocal)
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    # ASGITransport doesn't send lifespan events, so run startup and shutdown ourselves
+    async with main.lifespan(main.app), httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        if "email" in args.scenarios:
+            results["email"] = await bench_email(client, app, sink, args.recipients)
+        if "discord" in args.scenarios:
+            results["discord"] = await bench_discord(client, app, args.webhooks, args.discord_latency)
+        if "import" in args.scenarios:
+            results["import"] = await bench_import(client, app, args.import_sizes)
+        if "history" in args.scenarios:
+            results["history"] = await bench_history(client, app, args.history_size, args.repeats)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS), help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--recipients", type=int, default=10000)
+    parser.add_argument("--webhooks", type=int, default=50)
+    parser.add_argument("--discord-latency", type=float, default=0.02, help="seconds the mock Discord server takes per post")
+    parser.add_argument("--import-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1000, 10000, 100000])
+    parser.add_argument("--history-size", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args(argv)
+
+    sink = SMTPSink().start()
+    # The app reads its configuration at import, so point it at the stand-ins first
+    os.environ.setdefault("CONFIG_DIR", tempfile.mkdtemp(prefix="notifyagent-bench-"))
+    os.environ.update({
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(sink.port),
+        "SMTP_STARTTLS": "false",
+        "TAUTULLI_SYNC_INTERVAL": "0",
+        "HISTORY_RETENTION_DAYS": "0",
+    })
+    try:
+        results = asyncio.run(run(args, sink))
+    finally:
+        sink.stop()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return report
+
+if __name__ == "__main__":
+    main()
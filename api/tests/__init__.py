@@ -0,0 +1,12 @@
+"""
+Tests against local stand-ins for the external services. Run from the
+repository root with:
+
+    python -m unittest discover -s api/tests -t .
+"""
+import os
+import tempfile
+
+# The app's modules create their database and lock files under CONFIG_DIR at import
+os.environ.setdefault("CONFIG_DIR", tempfile.mkdtemp(prefix="notifyagent-test-"))
+os.environ.setdefault("TAUTULLI_SYNC_INTERVAL", "0")
@@ -0,0 +1,45 @@
+import time
+import unittest
+import uuid
+
+from api.api import auth
+
+class LoginThrottleTest(unittest.TestCase):
+    def setUp(self):
+        # Attempts are shared through a file; fresh names keep tests independent
+        self.username = f"user-{uuid.uuid4().hex}"
+        self.ip = f"ip-{uuid.uuid4().hex}"
+
+    def test_rejects_after_max_attempts_per_user(self):
+        throttle = auth.LoginThrottle(window=60, max_per_user=2, max_per_ip=100)
+        self.assertEqual(throttle.check(self.username, self.ip), 0)
+        self.assertEqual(throttle.check(self.username, "another-ip"), 0)
+
+        retry_after = throttle.check(self.username, self.ip)
+
+        self.assertGreater(retry_after, 59)
+        self.assertEqual(throttle.rejected, 1)
+
+    def test_reset_user_clears_user_attempts(self):
+        throttle = auth.LoginThrottle(window=60, max_per_user=1, max_per_ip=100)
+        throttle.check(self.username, self.ip)
+        throttle.reset_user(self.username)
+        self.assertEqual(throttle.check(self.username, self.ip), 0)
+
+    def test_attempts_are_shared_between_workers(self):
+        workers = [auth.LoginThrottle(window=60, max_per_user=100, max_per_ip=3) for _ in range(3)]
+        for worker in workers:
+            self.assertEqual(worker.check(f"{self.username}-{id(worker)}", self.ip), 0)
+
+        # Each worker saw one attempt from this IP, but together they reached the limit
+        self.assertGreater(workers[0].check(self.username, self.ip), 0)
+
+    def test_attempts_expire_after_window(self):
+        throttle = auth.LoginThrottle(window=0.2, max_per_user=1, max_per_ip=100)
+        throttle.check(self.username, self.ip)
+        self.assertGreater(throttle.check(self.username, self.ip), 0)
+        time.sleep(0.25)
+        self.assertEqual(throttle.check(self.username, self.ip), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import time
+import unittest
+from unittest import mock
+
+import httpx
+
+from api.api import discord
+from api.benchmarks.stand_ins import MockDiscord
+
+PAYLOAD = discord.build_payload("Subject", "Body", "")
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = httpx.AsyncClient(timeout=5)
+        # Limits are shared through a file; a namespace per test keeps them from leaking between tests
+        self.limiter = discord.RateLimiter(namespace=self.id())
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        # fan_out's shared client belongs to this test's event loop
+        await discord.close_client()
+
+    def start_server(self, **options):
+        server = MockDiscord(**options).start()
+        self.addCleanup(server.stop)
+        return server
+
+    async def post(self, server, index=0):
+        return await discord.post_webhook(self.client, f"channel-{index}", server.webhook_url(index), PAYLOAD, self.limiter)
+
+    async def test_waits_for_retry_after_and_retries(self):
+        server = self.start_server(rate_limit=1, window=0.3)
+        self.assertTrue((await self.post(server)).ok)
+
+        result = await self.post(server)
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.retries, 1)
+        self.assertEqual(self.limiter.retried, 1)
+        self.assertEqual(self.limiter.delayed, 1)
+        self.assertEqual(server.rate_limited, 1)
+        # The retry waited out the rest of the window instead of hammering the webhook
+        self.assertGreaterEqual(result.elapsed, 0.2)
+
+    async def test_gives_up_after_max_retries(self):
+        server = self.start_server(rate_limit=0, window=0.05)
+
+        with mock.patch.object(discord, "DISCORD_MAX_RETRIES", 2):
+            result = await self.post(server)
+
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(result.retries, 2)
+        self.assertEqual(server.requests, 3)
+
+    async def test_webhook_429_does_not_delay_other_webhooks(self):
+        server = self.start_server(rate_limit=1, window=5)
+        await self.post(server, 0)
+        with mock.patch.object(discord, "DISCORD_MAX_RETRIES", 0):
+            result = await self.post(server, 0)
+        self.assertEqual(result.status_code, 429)
+
+        start = time.perf_counter()
+        result = await self.post(server, 1)
+
+        self.assertTrue(result.ok)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertGreater(self.limiter._delay(server.webhook_url(0)), 4)
+
+    async def test_global_429_delays_every_webhook(self):
+        server = self.start_server(rate_limit=1, window=5, global_limit=True)
+        await self.post(server, 0)
+        with mock.patch.object(discord, "DISCORD_MAX_RETRIES", 0):
+            await self.post(server, 0)
+
+        for index in range(3):
+            self.assertGreater(self.limiter._delay(server.webhook_url(index)), 4)
+
+    async def test_limits_are_shared_between_workers(self):
+        server = self.start_server(rate_limit=1, window=5, global_limit=True)
+        await self.post(server, 0)
+        with mock.patch.object(discord, "DISCORD_MAX_RETRIES", 0):
+            await self.post(server, 0)
+
+        # Another worker's limiter reads the same state file
+        other_worker = discord.RateLimiter(namespace=self.id())
+        self.assertGreater(other_worker._delay(server.webhook_url(1)), 4)
+        self.assertLessEqual(discord.RateLimiter(namespace=f"{self.id()}-other")._delay(server.webhook_url(1)), 0)
+
+    async def test_global_rate_spreads_posts(self):
+        self.limiter.global_rate = 2
+        server = self.start_server()
+
+        start = time.perf_counter()
+        for index in range(3):
+            self.assertTrue((await self.post(server, index)).ok)
+
+        # The third post had to wait for the one-second window to move on
+        self.assertGreaterEqual(time.perf_counter() - start, 0.9)
+        self.assertEqual(self.limiter.delayed, 1)
+
+    async def test_fan_out_reports_each_webhook(self):
+        server = self.start_server(rate_limit=1, window=0.2)
+        webhooks = [(f"channel-{index}", server.webhook_url(index)) for index in range(5)] + [("broken", "http://[::1")]
+
+        with mock.patch.object(discord, "rate_limiter", self.limiter):
+            await discord.fan_out(webhooks, PAYLOAD)
+            results = await discord.fan_out(webhooks, PAYLOAD)
+
+        self.assertEqual([result.channel_name for result in results], [name for name, _ in webhooks])
+        self.assertTrue(all(result.ok and result.retries == 1 for result in results[:5]))
+        self.assertFalse(results[5].ok)
+        self.assertEqual(server.rate_limited, 5)
+
+if __name__ == "__main__":
+    unittest.main()
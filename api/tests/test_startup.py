@@ -0,0 +1,32 @@
+import unittest
+
+from api.api import main, migrations, models
+from api.api.database import SessionLocal, engine
+
+class InitializeDatabaseTest(unittest.TestCase):
+    def user_count(self):
+        db = SessionLocal()
+        try:
+            return db.query(models.User).count()
+        finally:
+            db.close()
+
+    def test_seeds_admin_when_schema_is_already_current(self):
+        main.initialize_database()
+        db = SessionLocal()
+        try:
+            db.query(models.User).delete()
+            db.commit()
+        finally:
+            db.close()
+
+        # A previous start migrated the schema but never seeded the admin user
+        self.assertFalse(migrations.run_migrations(engine))
+        main.initialize_database()
+
+        self.assertEqual(self.user_count(), 1)
+        main.initialize_database()
+        self.assertEqual(self.user_count(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
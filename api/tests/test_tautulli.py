@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from api.api import tautulli
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as fixture:
+        return fixture.read()
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        server.requests.append(params)
+        body = server.respond(params)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if server.truncate:
+            # Promise the whole body, send half of it and hang up
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def recorded_response(params):
+    """Serve the recorded payloads, paging get_users_table by start and length."""
+    if params.get("cmd") == "get_users":
+        return load_fixture("tautulli_get_users.json")
+    payload = json.loads(load_fixture("tautulli_get_users_table.json"))
+    start, length = int(params.get("start", 0)), int(params.get("length", 25))
+    payload["response"]["data"]["data"] = payload["response"]["data"]["data"][start:start + length]
+    return json.dumps(payload).encode()
+
+class StreamUsersTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.respond = recorded_response
+        self.server.truncate = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def profiles(self, page_size=0):
+        return list(tautulli.iter_user_profiles(self.base_url, "key", page_size=page_size))
+
+    expected = [
+        ("jdoe@example.com", "jdoe", "John"),
+        ("ann.lee@example.net", "ann.lee", "Ann Lee"),
+        ("m.kowalski@example.org", "mkowalski", "Marek éè"),
+    ]
+
+    def test_get_users(self):
+        self.assertEqual(self.profiles(), self.expected)
+        self.assertEqual([(request["cmd"], request["apikey"]) for request in self.server.requests], [("get_users", "key")])
+
+    def test_get_users_table_pages(self):
+        self.assertEqual(self.profiles(page_size=2), self.expected)
+        self.assertEqual([request["cmd"] for request in self.server.requests], ["get_users_table"] * 3)
+        self.assertEqual([int(request["start"]) for request in self.server.requests], [0, 2, 4])
+
+    def test_only_requested_fields_are_kept(self):
+        users = list(tautulli.iter_users(self.base_url, "key", ("email", "is_active")))
+        self.assertEqual(users[0], {"is_active": 1})
+        self.assertEqual(users[1], {"email": "jdoe@example.com", "is_active": 1})
+
+    def test_error_result(self):
+        self.server.respond = lambda params: load_fixture("tautulli_error.json")
+        for page_size in (0, 2):
+            with self.assertRaisesRegex(tautulli.TautulliError, "Failed to retrieve users"):
+                self.profiles(page_size)
+
+    def test_invalid_json(self):
+        self.server.respond = lambda params: b'{"response": {"result": "success", "data": [{"email": '
+        with self.assertRaisesRegex(tautulli.TautulliError, "Invalid response"):
+            self.profiles()
+
+    def test_connection_dropped_mid_stream(self):
+        self.server.truncate = True
+        with self.assertRaisesRegex(tautulli.TautulliError, "interrupted"):
+            self.profiles()
+
+    def test_unreachable(self):
+        with self.assertRaisesRegex(tautulli.TautulliError, "request failed"):
+            list(tautulli.iter_user_profiles("http://127.0.0.1:1/", "key"))
+
+if __name__ == "__main__":
+    unittest.main()
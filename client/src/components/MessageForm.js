@@ -10,6 +10,8 @@ import CheckCircleIcon from '@mui/icons-material/CheckCircle';
 import RadioButtonUncheckedIcon from '@mui/icons-material/RadioButtonUnchecked';
 
 const REACT_APP_API_BASE_URL = process.env.REACT_APP_API_BASE_URL;
+const JOB_POLL_INTERVAL_MS = 2000;
+const JOB_POLL_TIMEOUT_MS = 10 * 60 * 1000;
 
 function MessageForm() {
   const [subject, setSubject] = useState('');
@@ -112,37 +114,67 @@ function MessageForm() {
     }
   };
 
+  // The send endpoints only queue a delivery job, and the server records it in
+  // the history when it finishes; polling here only reports its status
+  const waitForDeliveryJob = async (jobId) => {
+    const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+      const response = await axios.get(`${REACT_APP_API_BASE_URL}/delivery_jobs/${jobId}`);
+      if (response.data.status !== 'queued' && response.data.status !== 'running') {
+        return response.data;
+      }
+      await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+    return null;
+  };
+
   const handleDialogClose = async (confirmed) => {
     setDialogOpen(false);
     if (confirmed) {
       try {
-        let servicesUsed = [];
+        let queuedJobs = [];
   
         if (sendEmail) {
-          await axios.post(`${REACT_APP_API_BASE_URL}/send_email/`, {
+          const emailResponse = await axios.post(`${REACT_APP_API_BASE_URL}/send_email/`, {
             subject,
             body
           });
-          servicesUsed.push(`email(${emailCount})`);
+          queuedJobs.push({ service: 'email', jobId: emailResponse.data.job_id });
         }
 
         if (sendDiscord) {
-          await axios.post(`${REACT_APP_API_BASE_URL}/send_discord/`, {
+          const discordResponse = await axios.post(`${REACT_APP_API_BASE_URL}/send_discord/`, {
             subject,
             body
           });
-          servicesUsed.push(`discord(${discordChannels.filter(channel => channel.is_active).length})`);
+          queuedJobs.push({ service: 'discord', jobId: discordResponse.data.job_id });
         }
-  
-        // Call the endpoint after messages are sent
-        await axios.post(`${REACT_APP_API_BASE_URL}/save_sent_message/`, {
-          subject,
-          body,
-          services: servicesUsed.join(', ')
-        });
 
-        setSnackbarMessage('Message sent successfully');
-        setSnackbarSeverity('success');
+        setSnackbarMessage(`Message queued for delivery (job ${queuedJobs.map(job => `#${job.jobId}`).join(', ')})`);
+        setSnackbarSeverity('info');
+        setSnackbarOpen(true);
+
+        const results = await Promise.all(queuedJobs.map(async (job) => ({ ...job, result: await waitForDeliveryJob(job.jobId) })));
+        const pending = results.filter(({ result }) => result === null);
+        if (pending.length > 0) {
+          setSnackbarMessage(`Delivery still in progress (job ${pending.map(({ jobId }) => `#${jobId}`).join(', ')}); it will appear in the message history once finished`);
+          setSnackbarSeverity('warning');
+          setSnackbarOpen(true);
+          return;
+        }
+
+        const problems = results.filter(({ result }) => result.status === 'failed' || result.failed > 0);
+        if (problems.length === 0) {
+          setSnackbarMessage('Message sent successfully');
+          setSnackbarSeverity('success');
+        } else {
+          setSnackbarMessage(problems.map(({ service, result }) => (
+            result.status === 'failed'
+              ? `${service} delivery failed: ${result.error || 'unknown error'}`
+              : `${service}: ${result.failed} of ${result.total} failed`
+          )).join('; '));
+          setSnackbarSeverity(results.some(({ result }) => result.sent > 0) ? 'warning' : 'error');
+        }
         setSnackbarOpen(true);
       } catch (error) {
         console.error('Error sending message:', error);